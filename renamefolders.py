@@ -3,14 +3,30 @@ import os
 import re
 import zipfile
 import shutil
+import json
+import zlib
+import hashlib
+import ntpath
+import csv
+import threading
+import queue
+import io
+import stat
+import errno
 
 #Flag constants
 ZIP_FLAGS = ['-z', '-zip', '-unzip']
 STUDENTS_FLAGS = ['-s', '-students']
 FLATTEN_FLAGS = ['-f', '-flatten']
+DEPTH_FLAGS = ['-d', '-depth', '-levels']
 EXTERNAL_FILE_FLAGS = ['-e', '-external']
 SHORTEN_EXTENSION_FLAGS = ['-x', '-extension', '-short', '-shorten']
 PROTECT_PREFIX_FLAGS = ['-p', '-protect', '-prefix']
+MANIFEST_FLAGS = ['-m', '-manifest']
+SHARD_FLAGS = ['-n', '-shard', '-node']
+THREADS_FLAGS = ['-t', '-threads', '-workers']
+VIEW_FLAGS = ['-w', '-view']
+SYMLINK_FLAGS = ['-l', '-symlink', '-symlinks']
 VERBOSE_FLAGS = ['-v', '-verbose']
 HELP_FLAGS = ['-h', '-help']
 
@@ -19,6 +35,17 @@ COMMENT = '#'
 SPACE = '~'
 IGNORE = set([".", "__"])
 SEP = "_"
+#Names of the files used to coordinate shards
+SHARD_FILE = ".renamefolders_shard_%d_of_%d"
+MERGE_LOCK = ".renamefolders_merge"
+#Name of the file marking a directory as a view
+VIEW_MARKER = ".renamefolders_view"
+#How many folders can wait between stages of the pipeline
+QUEUE_SIZE = 64
+
+#Moodle folder regex
+MOODLE_REGEX = re.compile(r"^\S* .*_\d*_assignsubmission_file_$")
+RENAMED_REGEX = re.compile(r"^\S*_\S*$")
 
 #Helper function for displaying text that doesn't wrap lines
 #in the Command Prompt
@@ -74,6 +101,16 @@ def display_help():
         "remove the folder structure and put all submissions in a "
         "single folder.")))
     print()
+    depth_string = DEPTH_FLAGS[0] + " (" +\
+        ', '.join(DEPTH_FLAGS[1:]) + ") depth"
+    print("\t%s\n%s"%(depth_string, display_format("If given along "
+        "with -f, also open up directories inside the students' folders, "
+        "up to depth levels deep (or all the way down, if depth is "
+        "\"all\"). The names of the directories opened up are put on "
+        "the front of the file names, e.g. src_main.py. Defaults to 0, "
+        "meaning directories are moved as they are. Can't be used "
+        "without -f.")))
+    print()
     student_string = STUDENTS_FLAGS[0] + " (" +\
         ', '.join(STUDENTS_FLAGS[1:]) + ") students_file"
     print("\t%s\n%s"%(student_string, display_format("If given, "
@@ -99,6 +136,52 @@ def display_help():
         "Can be passed multiple times; each flag takes "
         "only one argument.")))
     print()
+    shard_string = SHARD_FLAGS[0] + " (" +\
+        ', '.join(SHARD_FLAGS[1:]) + ") k/N"
+    print("\t%s\n%s"%(shard_string, display_format("If given, this "
+        "process handles only its share (the k-th of N) of the "
+        "student folders, so that N processes, possibly on different "
+        "machines sharing the directory, can split up a big download. "
+        "Run all N with the same options. Whichever process finishes "
+        "last does the flattening (with the number of threads given by "
+        "-t) and copies in the external files.")))
+    print()
+    manifest_string = MANIFEST_FLAGS[0] + " (" +\
+        ', '.join(MANIFEST_FLAGS[1:]) + ") manifest_file"
+    print("\t%s\n%s"%(manifest_string, display_format("If given, "
+        "write a list of who submitted, how many files and bytes they "
+        "submitted, and which file extensions they used, to "
+        "manifest_file. Students in the student file who didn't submit "
+        "are listed too. The list is JSON if manifest_file ends in "
+        ".json, and CSV otherwise.")))
+    print()
+    view_string = VIEW_FLAGS[0] + " (" +\
+        ', '.join(VIEW_FLAGS[1:]) + ") view_directory"
+    print("\t%s\n%s"%(view_string, display_format("If given, leave "
+        "the directory alone, and build the result in view_directory "
+        "instead, out of hard links to the original files (so it takes "
+        "almost no extra space). Files extracted from ZIPs and external "
+        "files are real copies. A view from an earlier run is cleared "
+        "out and built again; when used with -n, clear out an old view "
+        "yourself first. Editing a hard-linked file edits the "
+        "original too.")))
+    print()
+    symlink_string = SYMLINK_FLAGS[0] + " (" +\
+        ', '.join(SYMLINK_FLAGS[1:]) + ")"
+    print("\t%s\n%s"%(symlink_string, display_format("If given along "
+        "with -w, use symbolic links instead of hard links, e.g. if the "
+        "view is on a different file system.")))
+    print()
+    threads_string = THREADS_FLAGS[0] + " (" +\
+        ', '.join(THREADS_FLAGS[1:]) + ") threads"
+    print("\t%s\n%s"%(threads_string, display_format("If given, use "
+        "this many threads each for unzipping and for flattening. "
+        "Once every folder has been matched to a student, folders are "
+        "renamed and flattened while others are still being unzipped "
+        "either way. Defaults to 1; "
+        "with more threads, which file gets a number added when two "
+        "names collide can change from run to run.")))
+    print()
     zip_string = ZIP_FLAGS[0] + " (" + ', '.join(ZIP_FLAGS[1:]) + ")"
     print("\t%s\n%s"%(zip_string, display_format("If given, extract "
         "files from ZIP submissions")))
@@ -123,6 +206,10 @@ class Student:
         self.last = last.replace(SPACE, " ")
         self.nickname = nickname.replace(SPACE, " ")
         self.folder = None
+        #What the student submitted, for the manifest
+        self.file_count = 0
+        self.total_bytes = 0
+        self.extensions = set()
 
     #Check if this student has already been assigned a folder
     def has_folder(self):
@@ -136,6 +223,14 @@ class Student:
     def get_folder(self):
         return self.folder
 
+    #Count a file the student submitted
+    def add_file(self, name, size):
+        self.file_count += 1
+        self.total_bytes += size
+        ext = os.path.splitext(name)[1]
+        if len(ext) > 0:
+            self.extensions.add(ext)
+
     #For nice printing
     def get_student_name(self):
         if self.nickname == self.first:
@@ -213,21 +308,429 @@ def import_students_from_file(student_file):
     #Return the student list
     return students
 
+#Class for doing things to files on the disk
+#Everything that touches the folder being processed goes through
+#a backend like this one, so it can be swapped for a MemoryBackend
+class DiskBackend:
+    #List a directory, as os.scandir does
+    def scandir(self, path):
+        return os.scandir(path)
+
+    #Get the names of things in a directory
+    def listdir(self, path):
+        return os.listdir(path)
+
+    #Check if something is a directory
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    #Check if something is a file
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    #Make a directory, along with any missing parents
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok = True)
+
+    #Move something, as os.rename does
+    def rename(self, src, dst):
+        os.rename(src, dst)
+
+    #Move a file, replacing whatever file is already there
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+    #Delete a file
+    def remove(self, path):
+        os.remove(path)
+
+    #Delete an empty directory
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    #Delete a directory and everything in it
+    def rmtree(self, path):
+        shutil.rmtree(path)
+
+    #Open a file, as open does
+    def open(self, path, mode = 'r', newline = None):
+        return open(path, mode, newline = newline)
+
+    #Copy a file from the disk in
+    def copy_in(self, src, dst):
+        shutil.copy2(src, dst)
+
+    #Make a hard link to a file
+    def link(self, src, dst):
+        os.link(src, dst)
+
+    #Make a symbolic link
+    def symlink(self, src, dst):
+        os.symlink(src, dst)
+
+#Class for a symbolic link in a MemoryBackend, which just remembers the
+#path it points to
+class MemoryLink:
+    #Constructor
+    def __init__(self, target):
+        self.target = target
+
+#Class encapsulating an entry from MemoryBackend.scandir,
+#with the parts of os.DirEntry this program uses
+class MemoryEntry:
+    #Constructor
+    #node is the directory's dict, the file's bytes, or a MemoryLink;
+    #target is what a link points to (None if nothing), or node itself
+    def __init__(self, path, name, node, target):
+        self.path = path
+        self.name = name
+        self.node = node
+        self.target = target
+
+    #Check if this is a symbolic link
+    def is_symlink(self):
+        return isinstance(self.node, MemoryLink)
+
+    #Check if this is a directory
+    def is_dir(self, follow_symlinks = True):
+        if self.is_symlink() and not follow_symlinks:
+            return False
+        return isinstance(self.target, dict)
+
+    #Check if this is a file
+    def is_file(self, follow_symlinks = True):
+        if self.is_symlink() and not follow_symlinks:
+            return False
+        return self.target is not None and\
+            not isinstance(self.target, dict)
+
+    #Get the entry's size and type
+    def stat(self, follow_symlinks = True):
+        if self.is_symlink() and not follow_symlinks:
+            return os.stat_result((stat.S_IFLNK | 0o777, 0, 0, 1, 0, 0,
+                len(self.node.target), 0, 0, 0))
+        elif self.target is None:
+            raise FileNotFoundError(errno.ENOENT,
+                os.strerror(errno.ENOENT), self.path)
+        elif self.is_dir():
+            return os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0,
+                0, 0, 0, 0))
+        else:
+            return os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0,
+                len(self.target), 0, 0, 0))
+
+#Class for a file opened for writing in a MemoryBackend
+#Its contents are saved to the backend when it's closed
+class MemoryFile(io.BytesIO):
+    #Constructor
+    def __init__(self, parent, name, lock):
+        super().__init__()
+        self.parent = parent
+        self.name = name
+        self.lock = lock
+
+    #Save the contents, then close
+    def close(self):
+        if not self.closed:
+            with self.lock:
+                self.parent[self.name] = self.getvalue()
+        super().close()
+
+#Class for doing things to files kept in memory instead of on the disk
+#Directories are dicts from names to directories or files, files
+#are bytes, and symbolic links are MemoryLinks; paths are split on
+#os.sep from a single root
+#Useful for trying things out, or timing them, on lots of folders
+#without waiting on the disk
+class MemoryBackend:
+    #Constructor
+    def __init__(self):
+        self.root = dict()
+        #Lock for changing things, since several threads may be working
+        self.lock = threading.RLock()
+
+    #Find what's at a path, following symbolic links
+    def find(self, path, depth = 0):
+        node = self.root
+        for part in path.split(os.sep):
+            if len(part) == 0 or part == '.':
+                continue
+            if not isinstance(node, dict):
+                raise NotADirectoryError(errno.ENOTDIR,
+                    os.strerror(errno.ENOTDIR), path)
+            if part not in node:
+                raise FileNotFoundError(errno.ENOENT,
+                    os.strerror(errno.ENOENT), path)
+            node = self.follow(node[part], path, depth)
+        return node
+
+    #Get what a node is, following it if it's a symbolic link
+    #depth counts links followed, to stop at a loop of them
+    def follow(self, node, path, depth = 0):
+        if isinstance(node, MemoryLink):
+            if depth >= 40:
+                raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+            return self.find(node.target, depth + 1)
+        return node
+
+    #Find the directory something is in, and its name there
+    def find_parent(self, path):
+        head, name = os.path.split(path.rstrip(os.sep))
+        parent = self.find(head)
+        if not isinstance(parent, dict):
+            raise NotADirectoryError(errno.ENOTDIR,
+                os.strerror(errno.ENOTDIR), head)
+        return parent, name
+
+    #Find a directory, complaining if it isn't one
+    def find_dir(self, path):
+        node = self.find(path)
+        if not isinstance(node, dict):
+            raise NotADirectoryError(errno.ENOTDIR,
+                os.strerror(errno.ENOTDIR), path)
+        return node
+
+    #List a directory, as os.scandir does
+    def scandir(self, path):
+        with self.lock:
+            node = self.find_dir(path)
+            entries = []
+            for name in node:
+                try:
+                    target = self.follow(node[name], path)
+                except OSError:
+                    #A broken link
+                    target = None
+                entries.append(MemoryEntry(path + os.sep + name, name,
+                    node[name], target))
+            return iter(entries)
+
+    #Get the names of things in a directory
+    def listdir(self, path):
+        with self.lock:
+            return list(self.find_dir(path))
+
+    #Check if something is a directory
+    def isdir(self, path):
+        try:
+            return isinstance(self.find(path), dict)
+        except OSError:
+            return False
+
+    #Check if something is a file
+    def isfile(self, path):
+        try:
+            return not isinstance(self.find(path), dict)
+        except OSError:
+            return False
+
+    #Make a directory, along with any missing parents
+    def makedirs(self, path):
+        with self.lock:
+            node = self.root
+            for part in path.split(os.sep):
+                if len(part) == 0 or part == '.':
+                    continue
+                if part not in node:
+                    node[part] = dict()
+                node = self.follow(node[part], path)
+                if not isinstance(node, dict):
+                    raise FileExistsError(errno.EEXIST,
+                        os.strerror(errno.EEXIST), path)
+
+    #Move something, as os.rename does on Linux
+    def rename(self, src, dst):
+        with self.lock:
+            src_parent, src_name = self.find_parent(src)
+            if src_name not in src_parent:
+                raise FileNotFoundError(errno.ENOENT,
+                    os.strerror(errno.ENOENT), src)
+            dst_parent, dst_name = self.find_parent(dst)
+            node = src_parent[src_name]
+            if dst_name in dst_parent and dst_parent[dst_name] is not node:
+                old = dst_parent[dst_name]
+                if isinstance(old, dict) and not isinstance(node, dict):
+                    raise IsADirectoryError(errno.EISDIR,
+                        os.strerror(errno.EISDIR), dst)
+                elif isinstance(node, dict) and not isinstance(old, dict):
+                    raise NotADirectoryError(errno.ENOTDIR,
+                        os.strerror(errno.ENOTDIR), dst)
+                elif isinstance(old, dict) and len(old) > 0:
+                    raise OSError(errno.ENOTEMPTY,
+                        os.strerror(errno.ENOTEMPTY), dst)
+            del src_parent[src_name]
+            dst_parent[dst_name] = node
+
+    #Move a file, replacing whatever file is already there
+    def replace(self, src, dst):
+        self.rename(src, dst)
+
+    #Delete a file
+    def remove(self, path):
+        with self.lock:
+            parent, name = self.find_parent(path)
+            if name not in parent:
+                raise FileNotFoundError(errno.ENOENT,
+                    os.strerror(errno.ENOENT), path)
+            elif isinstance(parent[name], dict):
+                raise IsADirectoryError(errno.EISDIR,
+                    os.strerror(errno.EISDIR), path)
+            del parent[name]
+
+    #Delete an empty directory
+    def rmdir(self, path):
+        with self.lock:
+            if len(self.find_dir(path)) > 0:
+                raise OSError(errno.ENOTEMPTY,
+                    os.strerror(errno.ENOTEMPTY), path)
+            self.rmtree(path)
+
+    #Delete a directory and everything in it
+    def rmtree(self, path):
+        with self.lock:
+            self.find_dir(path)
+            parent, name = self.find_parent(path)
+            del parent[name]
+
+    #Open a file, as open does
+    #Files opened for writing are saved when they're closed
+    def open(self, path, mode = 'r', newline = None):
+        with self.lock:
+            if 'r' in mode:
+                data = self.find(path)
+                if isinstance(data, dict):
+                    raise IsADirectoryError(errno.EISDIR,
+                        os.strerror(errno.EISDIR), path)
+                fd = io.BytesIO(data)
+            else:
+                parent, name = self.find_parent(path)
+                #Write through symbolic links, to what they point to
+                while name in parent and\
+                        isinstance(parent[name], MemoryLink):
+                    parent, name = self.find_parent(parent[name].target)
+                if name in parent and isinstance(parent[name], dict):
+                    raise IsADirectoryError(errno.EISDIR,
+                        os.strerror(errno.EISDIR), path)
+                elif name in parent and 'x' in mode:
+                    raise FileExistsError(errno.EEXIST,
+                        os.strerror(errno.EEXIST), path)
+                #Make the file right away, so nobody else can claim it
+                parent[name] = b""
+                fd = MemoryFile(parent, name, self.lock)
+        if 'b' in mode:
+            return fd
+        else:
+            return io.TextIOWrapper(fd, encoding = 'utf-8',
+                newline = newline)
+
+    #Copy a file from the disk in
+    #If dst is a directory, the copy goes in it with the same name
+    def copy_in(self, src, dst):
+        with open(src, 'rb') as sfd:
+            data = sfd.read()
+        with self.lock:
+            if self.isdir(dst):
+                dst = dst + os.sep + os.path.basename(src)
+            parent, name = self.find_parent(dst)
+            parent[name] = data
+
+    #Make a hard link to a file, as os.link does
+    #In memory, a link is just the same contents under another name
+    #(files are never changed in place, so they can be shared)
+    def link(self, src, dst):
+        with self.lock:
+            node = self.find(src)
+            if isinstance(node, dict):
+                raise PermissionError(errno.EPERM,
+                    os.strerror(errno.EPERM), src)
+            parent, name = self.find_parent(dst)
+            if name in parent:
+                raise FileExistsError(errno.EEXIST,
+                    os.strerror(errno.EEXIST), dst)
+            parent[name] = node
+
+    #Make a symbolic link, as os.symlink does
+    def symlink(self, src, dst):
+        with self.lock:
+            parent, name = self.find_parent(dst)
+            if name in parent:
+                raise FileExistsError(errno.EEXIST,
+                    os.strerror(errno.EEXIST), dst)
+            parent[name] = MemoryLink(src)
+
+#The backend used for everything in the folder being processed
+backend = DiskBackend()
+
+#Check if a file or directory should be ignored
+#(i.e., its name starts with . or __)
+def is_ignored(name):
+    for ig in IGNORE:
+        if name[:len(ig)] == ig:
+            return True
+    return False
+
+#Check if a file name is a ZIP file's
+def is_zip(name):
+    return len(name) >= 4 and name[-4:] in {'.ZIP', '.zip'}
+
+#Split the name of a member of a ZIP file into the names of the
+#directories and file it should be extracted to, cleaned up the way
+#ZipFile.extractall does: any separator counts, drive letters and
+#parts that would go outside the directory (like ..) are left out, and
+#on Windows, characters Windows doesn't allow become _
+#sep and altsep are the separators of the system being extracted on
+def zip_member_parts(name, sep = os.sep, altsep = os.altsep):
+    name = name.replace('/', sep)
+    if altsep:
+        name = name.replace(altsep, sep)
+    if sep == '\\':
+        #Windows
+        name = ntpath.splitdrive(name)[1]
+    parts = [part for part in name.split(sep)\
+        if part not in {'', os.curdir, os.pardir}]
+    if sep == '\\':
+        table = str.maketrans(':<>|"?*', '_______')
+        parts = [part.translate(table).rstrip('.') for part in parts]
+        parts = [part for part in parts if len(part) > 0]
+    return parts
+
+#Extract everything in a ZIP file into a directory, as
+#ZipFile.extractall does, but through the backend
+#Like extractall, leaves out any part of a member's name that would
+#put it outside the directory; see zip_member_parts
+#Returns the names of the top level directories it made
+def extract_zip(z, dirc):
+    top_dircs = []
+    for member in z.infolist():
+        parts = zip_member_parts(member.filename)
+        if len(parts) == 0:
+            continue
+        if (len(parts) > 1 or member.is_dir()) and\
+                parts[0] not in top_dircs:
+            top_dircs.append(parts[0])
+        target = dirc + os.sep + os.sep.join(parts)
+        if member.is_dir():
+            backend.makedirs(target)
+        else:
+            backend.makedirs(os.path.dirname(target))
+            #Replace, rather than write over, anything already there,
+            #in case it's a link into somebody's original files
+            if backend.isfile(target):
+                backend.remove(target)
+            with z.open(member) as src, backend.open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    return top_dircs
+
 #Given a directory, unzip all ZIP files in that directory
 #and extract to that directory
 def unzip_zips(dirc, verbose = False):
-    #Remember the current working directory
-    cur_wd = os.getcwd()
-    #Change working directory to the one we care about
-    os.chdir(dirc)
     #Look for ZIP files
     if verbose:
         print("Looking for ZIP files in %s"%dirc)
     dircs = set()
     zips = []
-    for itm in os.scandir(dirc):
-        if itm.is_file() and len(itm.name) >= 4 and\
-                itm.name[-4:] in {'.ZIP', '.zip'}:
+    for itm in backend.scandir(dirc):
+        if itm.is_file() and is_zip(itm.name):
             #We found one!
             if verbose:
                 print("Found ZIP: %s"%itm.name)
@@ -236,59 +739,960 @@ def unzip_zips(dirc, verbose = False):
             #Keep track of what directories were already there
             dircs.add(itm.name)
     #Extract the ZIPs and delete them
+    #The ZIP's list of names tells us which directories it creates,
+    #so we don't need to look through the directory again afterwards
+    new_dircs = []
     for zip in zips:
         #Do the extract
-        with zipfile.ZipFile(zip, 'r') as z:
-            z.extractall()
+        with backend.open(dirc + os.sep + zip, 'rb') as zfd,\
+                zipfile.ZipFile(zfd, 'r') as z:
+            for top_dirc in extract_zip(z, dirc):
+                if top_dirc not in dircs:
+                    #We found a new directory
+                    if verbose:
+                        print("New directory found: %s"%top_dirc)
+                    dircs.add(top_dirc)
+                    new_dircs.append(top_dirc)
         if verbose:
             print("Extract successful")
-        os.remove(zip)
+        backend.remove(dirc + os.sep + zip)
         if verbose:
             print("Deleted file %s"%zip)
-    #Look for new directories and flatten them out
-    if verbose:
-        print("Looking for directories created by unzip")
-    new_dircs = []
-    for itm in os.scandir(dirc):
-        if itm.is_dir() and itm.name not in dircs:
-            #We found a new directory
-            if verbose:
-                print("New directory found: %s"%itm.name)
-            new_dircs.append(itm.name)
+    #Flatten out the new directories
     for new_dirc in new_dircs:
+        new_path = dirc + os.sep + new_dirc
         #Extract the files from it, if relevant
         #Ignore if starts with . or __
-        ignore = False
-        for ig in IGNORE:
-            if new_dirc[:len(ig)] == ig:
-                ignore = True
-                break
-        if ignore:
+        if is_ignored(new_dirc):
             #Delete the whole thing
-            shutil.rmtree(new_dirc)
+            backend.rmtree(new_path)
             if verbose:
                 print("Deleted irrelevant directory: %s"%new_dirc)
         else:
-            move_files = []
-            for in_itm in os.scandir(new_dirc):
-                #Tag file for moving
-                move_files.append(in_itm)
-                if verbose:
-                    print("File/directory %s tagged for moving"%in_itm.name)
-            for move_file in move_files:
+            for in_itm in backend.scandir(new_path):
                 #Move the file
-                os.rename(move_file.path, move_file.name)
+                backend.rename(in_itm.path, dirc + os.sep + in_itm.name)
                 if verbose:
                     print("Renamed file/directory %s to %s"%\
-                        (move_file.path, move_file.name))
+                        (in_itm.path, in_itm.name))
             #Remove the directory
-            os.rmdir(new_dirc)
+            backend.rmdir(new_path)
             if verbose:
                 print("Removed directory %s"%new_dirc)
-    #Done. Go back to the old working directory
     if verbose:
         print("Done looking for ZIP files")
-    os.chdir(cur_wd)
+
+#Walk through a student's folder, finding everything that needs to be
+#moved to flatten it
+#Directories are opened up until depth levels of them have been removed
+#(None means keep going all the way down), and the names of the
+#directories passed through are put on the front of the file's name
+#Each directory is only looked through once
+#If a student is given, their files are counted for the manifest
+#along the way, including the ones inside directories being moved whole
+#(and inside symbolic links to directories, which are never opened up)
+#Returns a list of (DirEntry, flattened name) pairs
+def walk_folder(dirc, depth = 0, verbose = False, student = None):
+    moves = []
+    #Directories left to look through, along with the start of the names
+    #of things in them and how many more levels we can open up
+    #A prefix of None means the directory is being moved whole,
+    #and we're only looking inside to count files
+    to_walk = [(dirc, "", depth)]
+    while len(to_walk) > 0:
+        cur_dirc, prefix, levels = to_walk.pop()
+        for itm in backend.scandir(cur_dirc):
+            if is_ignored(itm.name):
+                #Leave it; it goes away with the student's folder
+                if verbose and prefix is not None:
+                    print("Skipping irrelevant file/directory: %s"%\
+                        itm.path)
+            elif itm.is_dir(follow_symlinks = False):
+                if prefix is None:
+                    #Keep counting
+                    to_walk.append((itm.path, None, None))
+                elif levels is None:
+                    #Open it up
+                    to_walk.append((itm.path, prefix + itm.name + SEP,\
+                        None))
+                elif levels > 0:
+                    #Open it up
+                    to_walk.append((itm.path, prefix + itm.name + SEP,\
+                        levels - 1))
+                else:
+                    #Tag directory for moving
+                    moves.append((itm, prefix + itm.name))
+                    if verbose:
+                        print("File/directory %s tagged for moving"%\
+                            itm.path)
+                    if student is not None:
+                        #Still need to count what's in it
+                        to_walk.append((itm.path, None, None))
+            elif itm.is_dir():
+                #A symbolic link to a directory, moved as it is
+                if prefix is not None:
+                    #Tag link for moving
+                    moves.append((itm, prefix + itm.name))
+                    if verbose:
+                        print("File/directory %s tagged for moving"%\
+                            itm.path)
+                if student is not None:
+                    #Still need to count what's in it
+                    to_walk.append((itm.path, None, None))
+            else:
+                if student is not None:
+                    #A broken link counts as an empty file
+                    try:
+                        size = itm.stat().st_size
+                    except OSError:
+                        size = 0
+                    student.add_file(itm.name, size)
+                if prefix is not None:
+                    #Tag file for moving
+                    moves.append((itm, prefix + itm.name))
+                    if verbose:
+                        print("File/directory %s tagged for moving"%\
+                            itm.path)
+    return moves
+
+#Make a copy of a directory out of links, for a view
+#Directories are made again, and files get hard links (or symbolic
+#links, if symlink is True), so that nothing put into the copy later
+#(e.g. extracted from a ZIP) can end up in the original
+#Anything already in dst is kept
+def link_tree(src, dst, symlink = False):
+    backend.makedirs(dst)
+    existing = set(backend.listdir(dst))
+    for itm in backend.scandir(src):
+        target = dst + os.sep + itm.name
+        if itm.name in existing:
+            #Fill in what's missing from a directory that's already there
+            if itm.is_dir() and backend.isdir(target):
+                link_tree(itm.path, target, symlink)
+        elif itm.is_dir(follow_symlinks = False):
+            link_tree(itm.path, target, symlink)
+        elif symlink:
+            backend.symlink(itm.path, target)
+        else:
+            backend.link(itm.path, target)
+
+#Set up a student's folder in a view: link in everything, then extract
+#their ZIP files into it if unzip is True, just as it would have been
+#renamed and unzipped in place
+def view_folder(folder, view, student, dname, unzip = False,
+        symlink = False, verbose = False):
+    link_tree(folder + os.sep + dname, view + os.sep + student.get_folder(),
+        symlink)
+    if verbose:
+        print("Linked %s into view as %s"%(dname, student.get_folder()))
+    if unzip:
+        unzip_zips(view + os.sep + student.get_folder(), verbose)
+
+#Get a view ready to be built
+#A view left by an earlier run (which has VIEW_MARKER in it) is cleared
+#out, so that it can be built again with different options; anything
+#else that isn't empty is left alone
+#If clear is False, the view is never cleared, for when other
+#processes may already be building it
+#Raises ValueError if the directory can't be used
+def prepare_view(view, clear = True, verbose = False):
+    if backend.isdir(view):
+        if clear and backend.isfile(view + os.sep + VIEW_MARKER):
+            backend.rmtree(view)
+            if verbose:
+                print("Cleared out old view %s"%view)
+        elif clear and len(backend.listdir(view)) > 0:
+            raise ValueError("Error: view directory is not empty and "
+                "is not a view: %s"%view)
+    elif backend.isfile(view):
+        raise ValueError("Error: view is a file: %s"%view)
+    backend.makedirs(view)
+    if not backend.isfile(view + os.sep + VIEW_MARKER):
+        with backend.open(view + os.sep + VIEW_MARKER, 'w') as vfd:
+            vfd.write("Made by renamefolders.py; safe to delete\n")
+
+#Given a folder name (either straight from Moodle or already renamed),
+#get a key identifying the student it belongs to
+#The key is built from the words of the student's name, so it is the same
+#before and after renaming, and students with the same name share a key
+def student_key(dname):
+    if MOODLE_REGEX.match(dname):
+        #Name is everything before the first underscore
+        words = dname[:dname.find(SEP)].split()
+    else:
+        sname = dname.split(SEP + SEP)
+        if len(sname) >= 2:
+            #Remove numbers from end of first name
+            words = (sname[0] + SEP + sname[1].rstrip("0123456789")).\
+                split(SEP)
+        else:
+            words = dname.split(SEP)
+    return " ".join(sorted(word for word in words if len(word) > 0))
+
+#Figure out which shard a folder belongs to
+#Uses a CRC rather than hash(), since hash() of a string differs
+#from process to process
+def shard_of(dname, shard_count):
+    return zlib.crc32(student_key(dname).encode('utf-8')) % shard_count
+
+#Scan the folder for Moodle download folders and already renamed folders,
+#and match each one to a student
+#If shard is given as (index, count), only look at folders belonging
+#to that shard
+#Generates (student, student number, folder name) for each folder as soon
+#as it's matched; the student has been assigned the folder's new name
+def match_folders(folder, students = None, shard = None, verbose = False):
+    #Names the folders will have
+    dnames = set()
+    #Scan the specified folder for directories
+    #Read the whole listing up front, since folders may get renamed
+    #while we're still matching
+    if verbose:
+        print("Scanning for Moodle download folders")
+    for itm in list(backend.scandir(folder)):
+        #Check if we're looking at a directory
+        if not itm.is_dir():
+            continue
+        #Check if it's some other process's job
+        if shard is not None and\
+                shard_of(itm.name, shard[1]) != shard[0]:
+            continue
+        #Now, check if it's a directory from Moodle
+        if MOODLE_REGEX.match(itm.name):
+            #It is
+            if verbose:
+                print("Found yet to be processed folder %s"%itm.name)
+            #Get the tokens before the first underscore
+            #and get the part after the underscore
+            uindex = itm.name.find(SEP)
+            sname = itm.name[:uindex].split()
+            #Figure out the corresponding student
+            if students is None:
+                #Make one up
+                #Assume first name is one word
+                first = sname[0]
+                last = SPACE.join(sname[1:])
+                student = Student(first, last, first)
+                student_num = 0
+                while student.get_id_string(student_num) in dnames:
+                    #Need to increase student_num
+                    student_num += 1
+            else:
+                #Check all possible parsings of the student's name
+                student = None
+                for split_loc in range(1, len(sname)):
+                    #Try a name
+                    try_student = Student(SPACE.join(sname[:split_loc]),\
+                        SPACE.join(sname[split_loc:]),\
+                        SPACE.join(sname[:split_loc]))
+                    done_trying = False
+                    #Loop in case there are multiple students
+                    #with the same name
+                    i = 0
+                    while True:
+                        #Does the student associated with this folder
+                        #actually exist?
+                        if "%s%d"%(str(try_student), i) not in students:
+                            break
+                        #Given yes, is it a duplicate that we've already
+                        #assigned before
+                        elif students["%s%d"%(str(try_student), i)].\
+                                has_folder():
+                            i += 1
+                        #Ok, we're good to assign the folder
+                        else:
+                            student = students["%s%d"%(str(try_student),\
+                                i)]
+                            student_num = i
+                            if verbose:
+                                print("Folder belongs to student %s"%\
+                                    student.get_student_name())
+                            done_trying = True
+                            break
+                    if done_trying:
+                        break
+                if student is None:
+                    #We failed to find a student
+                    raise ValueError("Error: folder %s has no "
+                        "corresponding student"%itm.name)
+            #Keep track of the directory's future name
+            new_name = student.get_id_string(student_num)
+            dnames.add(new_name)
+            student.assign_folder(new_name)
+            if verbose:
+                print("Matching student %s to folder %s with number %d"%\
+                    (str(student), student.get_folder(), student_num))
+            yield student, student_num, itm.name
+        #Next, check if it's already been renamed by our program
+        elif RENAMED_REGEX.match(itm.name):
+            #It is
+            if verbose:
+                print("Found already renamed folder %s"%itm.name)
+            sname = itm.name.split(SEP + SEP)
+            #Make up a student
+            first = sname[1]
+            #remove numbers from end of first
+            while ord(first[-1]) >= ord('0') and\
+                    ord(first[-1]) <= ord('9'):
+                first = first[:-1]
+            #Student's number
+            student_num = 0
+            if first != sname[1]:
+                student_num = int(sname[1][len(first):])
+            #Last name
+            last = sname[0]
+            try_student = Student(first, last, first)
+            #Figure out the corresponding student
+            if students is None:
+                #Make one up
+                student = try_student
+            elif itm.name + '0' in students:
+                #Default student, no repeatss
+                student = students[itm.name + '0']
+            elif itm.name not in students:
+                raise ValueError("Error: folder %s has no "
+                    "corresponding student"%itm.name)
+            else:
+                student = students[itm.name]
+            #Keep track of the directory's name
+            dnames.add(itm.name)
+            student.assign_folder(itm.name)
+            if verbose:
+                print("Matching student %s to folder %s with number %d"%\
+                    (str(student), student.get_folder(), student_num))
+            yield student, student_num, itm.name
+
+#Rename a student's folder to the name it was given by match_folders,
+#if it doesn't have that name already
+def rename_folder(folder, student, dname, verbose = False):
+    if dname != student.get_folder():
+        backend.rename(folder + os.sep + dname,
+            folder + os.sep + student.get_folder())
+        if verbose:
+            print("Renamed %s to %s"%(dname, student.get_folder()))
+
+#Given the list of student folders, find the shortest unique prefix
+#of each one, for use as a shortened file name
+#Returns a dictionary from folder name to shortened name
+def find_folder_prefixes(folder_list, verbose = False):
+    if verbose:
+        print()
+        print("Figuring out shortened names")
+    #Sort the list of folders
+    folder_list = sorted(folder_list)
+    #Look for optimal prefixes
+    folder_prefixes = dict()
+    lnames = dict()
+    #First, group everybody by last name
+    #Folders of people with the SAME name are the name with a number
+    #on the end; when sorted, these come right after the name, mixed in
+    #with longer names starting with it (e.g. Smith__Anna after Smith__Ann)
+    repeats = set()
+    for i in range(len(folder_list)):
+        fldr = folder_list[i]
+        if fldr in repeats:
+            continue
+        #Look for people with the SAME name
+        numbers = []
+        j = i + 1
+        while j < len(folder_list) and\
+                folder_list[j][:len(fldr)] == fldr:
+            if folder_list[j][len(fldr):].isdigit():
+                numbers.append(folder_list[j][len(fldr):])
+                repeats.add(folder_list[j])
+            j += 1
+        #Figure out the current last name
+        lname = fldr[:folder_list[i].find(SEP)]
+        if lname not in lnames:
+            lnames[lname] = []
+        #Create an entry, keeping track of the numbers of the other
+        #people with that name
+        lnames[lname].append((fldr, numbers))
+        if verbose:
+            print("Name %s; last name %s; %d people"%(fldr, lname,
+                len(numbers) + 1))
+    #Now, go through and find unique prefixes
+    for lname in lnames:
+        if verbose:
+            print("Now considering last name %s"%lname)
+        #Loop through the names with that last name
+        #They're sorted, so the names sharing the most with each name
+        #are the ones right next to it
+        group = lnames[lname]
+        lengths = dict()
+        for i in range(len(group)):
+            #Get the folder name and the index after the last name
+            fldr = group[i][0]
+            idx = fldr.find(SEP)
+            #Extend the prefix past what it shares with its neighbors,
+            #so it's unique
+            for j in (i - 1, i + 1):
+                if j >= 0 and j < len(group):
+                    idx = max(idx, len(os.path.commonprefix([fldr,\
+                        group[j][0]])) + 1)
+            #The whole name is unique, even if it starts another name
+            lengths[fldr] = min(idx, len(fldr))
+        #Taking the underscores out can make prefixes the same again
+        #(e.g. Li__Mary, and Li__Mary_ for Li__Mary_Ann), so make those
+        #longer, by a letter at a time, until they're different
+        while True:
+            shorts = dict()
+            for fldr in lengths:
+                short = fldr[:lengths[fldr]].replace(SEP, "")
+                if short not in shorts:
+                    shorts[short] = []
+                shorts[short].append(fldr)
+            longer = [fldr for short in shorts for fldr in shorts[short]\
+                if len(shorts[short]) > 1 and lengths[fldr] < len(fldr)]
+            if len(longer) == 0:
+                break
+            for fldr in longer:
+                lengths[fldr] += 1
+                while lengths[fldr] < len(fldr) and\
+                        fldr[lengths[fldr] - 1] == SEP:
+                    lengths[fldr] += 1
+        for fldr, numbers in group:
+            #Remove underscores from the shortened name
+            name = fldr[:lengths[fldr]].replace(SEP, "")
+            if verbose:
+                print("Found unique prefix %s"%name)
+            #Let's roll with it
+            folder_prefixes[fldr] = name
+            #In case there were multiple people with the same name
+            #Need to account for all of them
+            for number in numbers:
+                folder_prefixes[fldr + number] = name + number
+            if verbose:
+                print("Updated %d entries"%(len(numbers) + 1))
+    #Make sure the shortened names really are all different; any that
+    #aren't (e.g. Li__Mary and Li__Ma_ry, which are the same without
+    #underscores) just keep the whole folder name, which has underscores,
+    #so can't be anybody's shortened name
+    uses = dict()
+    for fldr in folder_prefixes:
+        name = folder_prefixes[fldr]
+        uses[name] = uses.get(name, 0) + 1
+    for fldr in folder_prefixes:
+        if uses[folder_prefixes[fldr]] > 1:
+            folder_prefixes[fldr] = fldr
+            if verbose:
+                print("Prefix for %s changed to %s"%(fldr, fldr))
+    return folder_prefixes
+
+#Class that moves the contents of students' folders into the main folder,
+#renaming them to say whose they are, and removes the student folders
+#Directories inside the student folders are opened up depth levels deep
+#(None means all the way down); see walk_folder
+#If count is True, also counts each student's files for the manifest
+#If source is given, folder is a view: files in the students' original
+#folders in source are linked into it (hard links, or symbolic links if
+#symlink is True) instead of moved, and the originals are left alone
+#(A view whose ZIP files are extracted is instead set up by view_folder
+#first, and then flattened without a source, by moving)
+#Several threads can flatten different students' folders at once
+#This works even if you've already done the rest
+class Flattener:
+    #Constructor
+    def __init__(self, folder, shorten_extensions = set(),
+            protected_prefixes = set(), depth = 0, count = False,
+            verbose = False, source = None, symlink = False):
+        self.folder = folder
+        self.shorten_extensions = shorten_extensions
+        self.protected_prefixes = protected_prefixes
+        self.depth = depth
+        self.count = count
+        self.verbose = verbose
+        self.source = source
+        self.symlink = symlink
+        #Shortened names; if there are extensions to shorten, these
+        #have to be given by set_prefixes before flattening anything
+        if len(shorten_extensions) > 0:
+            self.folder_prefixes = None
+        else:
+            self.folder_prefixes = dict()
+        #Names already used in the main folder, so that we can find
+        #collisions without checking the disk for every file
+        self.taken = set(backend.listdir(folder))
+        #Lock for the names used
+        self.lock = threading.Lock()
+
+    #Check if we still need the shortened names
+    def needs_prefixes(self):
+        return self.folder_prefixes is None
+
+    #Give the shortened names, found by find_folder_prefixes
+    def set_prefixes(self, folder_prefixes):
+        self.folder_prefixes = folder_prefixes
+
+    #Figure out the name a file should get in the main folder
+    def new_name(self, student, student_num, move_file, flat_name):
+        s_folder = student.get_folder()
+        #Make the new name
+        if student_num == 0:
+            new_name = s_folder + SEP + flat_name
+        else:
+            new_name = student.last.replace(" ", SEP) +\
+                str(student_num) + SEP + SEP +\
+                student.first.replace(" ", SEP) + SEP + flat_name
+        #Check if need to shorten filename
+        for ext in self.shorten_extensions:
+            if move_file.name[-len(ext):] == ext:
+                if self.verbose:
+                    print("File %s has extension %s"%\
+                        (move_file.name, ext))
+                #We've matched an extension to shorten
+                #Check if we need to actually not shorten it
+                protected = False
+                for pre in self.protected_prefixes:
+                    if move_file.name[:len(pre)] == pre:
+                        #We actually need to not shorten it
+                        protected = True
+                        if self.verbose:
+                            print("File %s has protected prefix %s"%\
+                                (move_file.name, pre))
+                        break
+                if not protected:
+                    #Do the rename
+                    #Use the prefix created earlier
+                    new_name = self.folder_prefixes[s_folder] + ext
+                    if self.verbose:
+                        print("File %s tagged for renaming to %s"%\
+                            (move_file.name, new_name))
+                break
+        return new_name
+
+    #Move a file into the main folder, avoiding any name already there
+    #If link is True, link it in from the original folder instead
+    def move(self, move_file, new_name, link = False):
+        with self.lock:
+            #Check if the file already exists
+            if new_name in self.taken:
+                if self.verbose:
+                    print("File %s already exists"%new_name)
+                #Append a number to make it not already exist
+                dot_index = new_name.rfind(".")
+                #If there is no dot, we'll add numbers to the end
+                if dot_index == -1:
+                    dot_index = len(new_name)
+                #Ignore files that start with dot
+                if dot_index != 0:
+                    #Loop until we find an available name
+                    i = 0
+                    while new_name[:dot_index] + SEP + str(i) +\
+                            new_name[dot_index:] in self.taken:
+                        i += 1
+                    #Use the available name
+                    new_name = new_name[:dot_index] + SEP + str(i) +\
+                        new_name[dot_index:]
+                    if self.verbose:
+                        print("Instead using name %s"%new_name)
+            self.taken.add(new_name)
+        if link:
+            #Link the file; a directory is made again, so that nothing
+            #put into it can end up in the original
+            if move_file.is_dir(follow_symlinks = False):
+                link_tree(move_file.path, self.folder + os.sep + new_name,
+                    self.symlink)
+            elif self.symlink:
+                backend.symlink(move_file.path,
+                    self.folder + os.sep + new_name)
+            else:
+                backend.link(move_file.path, self.folder + os.sep + new_name)
+            if self.verbose:
+                print("Linked file/directory %s as %s"%\
+                    (move_file.path, self.folder + os.sep + new_name))
+        else:
+            #Move the file
+            backend.rename(move_file.path, self.folder + os.sep + new_name)
+            if self.verbose:
+                print("Renamed file/directory %s to %s"%\
+                    (move_file.path, self.folder + os.sep + new_name))
+
+    #Remove a student's folder, along with anything irrelevant left in it
+    #In a view with a source, there's no folder to remove
+    def remove(self, student):
+        if self.source is None:
+            backend.rmtree(self.folder + os.sep + student.get_folder())
+            if self.verbose:
+                print("Removed directory %s"%student.get_folder())
+
+    #Flatten one student's folder
+    #dname is the name of the student's original folder in source,
+    #if there is a source
+    def flatten(self, student, student_num, dname = None):
+        #Find everything to move, all in one go
+        if self.count:
+            count_student = student
+        else:
+            count_student = None
+        if self.source is None:
+            moves = walk_folder(self.folder + os.sep + student.get_folder(),
+                self.depth, self.verbose, count_student)
+        else:
+            moves = walk_folder(self.source + os.sep + dname, self.depth,
+                self.verbose, count_student)
+        for move_file, flat_name in moves:
+            self.move(move_file, self.new_name(student, student_num,
+                move_file, flat_name), self.source is not None)
+        self.remove(student)
+
+#Flatten each student's folder with the given Flattener, using the
+#given number of threads
+#Entries in s_list are [student, student number, original folder name]
+def flatten_folders(flattener, s_list, threads = 1, verbose = False):
+    if verbose:
+        print()
+        print("Flattening")
+    run_stage(lambda item: flattener.flatten(item[0], item[1], item[2]),
+        s_list, threads)
+
+#Count a student's files for the manifest, when we aren't
+#flattening (which would count them anyway)
+def count_folder(folder, student, verbose = False):
+    walk_folder(folder + os.sep + student.get_folder(), student = student)
+    if verbose:
+        print("Counted %d files in %s"%(student.file_count,
+            student.get_folder()))
+
+#Count each student's files for the manifest, using the given number
+#of threads; see count_folder
+def count_files(folder, s_list, threads = 1, verbose = False):
+    if verbose:
+        print()
+        print("Counting files")
+    run_stage(lambda item: count_folder(folder, item[0], verbose), s_list,
+        threads)
+
+#Class encapsulating one stage of the pipeline in run_pipeline:
+#some threads taking folders off a bounded queue, doing work on each,
+#and passing them on to the next stage
+class Stage:
+    #Constructor
+    #work is called with each item; if it raises an exception, the
+    #exception is kept in error, and this stage and every other stage
+    #in the same pipeline stop doing work (they share cancel)
+    def __init__(self, work, threads = 1, next_stage = None):
+        self.work = work
+        self.next_stage = next_stage
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.error = None
+        if next_stage is None:
+            self.cancel = threading.Event()
+        else:
+            self.cancel = next_stage.cancel
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target = self.run)
+            thread.start()
+            self.threads.append(thread)
+
+    #Give the stage an item to work on
+    #Waits if the queue is full
+    def put(self, item):
+        self.queue.put(item)
+
+    #What each thread does
+    def run(self):
+        while True:
+            item = self.queue.get()
+            #None means there's nothing left
+            if item is None:
+                break
+            #Skip everything after something goes wrong anywhere
+            if self.cancel.is_set():
+                continue
+            try:
+                self.work(item)
+            except Exception as e:
+                self.error = e
+                self.cancel.set()
+                continue
+            if self.next_stage is not None:
+                self.next_stage.put(item)
+
+    #Wait for the stage to finish everything, then close the next one
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.next_stage is not None:
+            self.next_stage.close()
+
+#Do work on each of items with a single Stage, using the given number
+#of threads
+#Raises whatever the work raised, if anything
+def run_stage(work, items, threads = 1):
+    stage = Stage(work, threads)
+    try:
+        for item in items:
+            if stage.cancel.is_set():
+                break
+            stage.put(item)
+    finally:
+        stage.close()
+    if stage.error is not None:
+        raise stage.error
+
+#Process the folders: first match every folder to a student, which
+#only needs the one listing of the directory, so a folder with no
+#corresponding student stops everything before anything is changed;
+#then run them through a pipeline, where as soon as a folder is
+#unzipped, it goes on to be renamed, then flattened (or counted, if
+#count is True), each stage overlapping with the others
+#If anything goes wrong in the pipeline, every stage stops taking on
+#new folders, and folders already done are left done
+#If view is given, the folders are left alone, and instead each one
+#is set up in the view by view_folder, unless flatten is True and there
+#are no ZIP files to extract (then the flattener, or later on the
+#merge, links everything from folder by itself)
+#The unzip, view, and flatten stages use the given number of threads
+#Raises ValueError if a folder has no corresponding student
+#Returns the list of [student, student number, original folder name]
+def run_pipeline(folder, students = None, unzip = False, shard = None,
+        flattener = None, count = False, threads = 1, verbose = False,
+        view = None, symlink = False, flatten = False):
+    #Match every folder
+    s_list = [list(item) for item in match_folders(folder, students,
+        shard, verbose)]
+    #Everybody's matched, so we can figure out shortened names
+    if flattener is not None and flattener.needs_prefixes():
+        flattener.set_prefixes(find_folder_prefixes(
+            [sn[0].get_folder() for sn in s_list], verbose))
+    #Set up the stages, starting from the end
+    stages = []
+    if flattener is not None:
+        stages.append(Stage(lambda item: flattener.flatten(item[0],
+            item[1], item[2]), threads))
+    elif count and view is not None:
+        stages.append(Stage(lambda item: count_folder(view, item[0],
+            verbose), threads))
+    elif count:
+        stages.append(Stage(lambda item: count_folder(folder, item[0],
+            verbose), threads))
+    if len(stages) > 0:
+        next_stage = stages[-1]
+    else:
+        next_stage = None
+    if view is not None:
+        if unzip or not flatten:
+            stages.append(Stage(lambda item: view_folder(folder, view,
+                item[0], item[2], unzip, symlink, verbose), threads,
+                next_stage))
+    else:
+        stages.append(Stage(lambda item: rename_folder(folder, item[0],
+            item[2], verbose), 1, next_stage))
+        if unzip:
+            stages.append(Stage(lambda item: unzip_zips(folder + os.sep +\
+                item[2], verbose), threads, stages[-1]))
+    #Feed the folders in, if there's anything to do with them
+    #(a view that only gets flattened later on, by the merge, has
+    #nothing to do here)
+    if len(stages) > 0:
+        try:
+            for item in s_list:
+                if stages[-1].cancel.is_set():
+                    break
+                stages[-1].put(item)
+        finally:
+            #Let everything drain out
+            stages[-1].close()
+    #Pass along anything that went wrong, earliest stage first
+    for stage in reversed(stages):
+        if stage.error is not None:
+            raise stage.error
+    return s_list
+
+#Write out a manifest of who submitted what
+#Students from the student file who never got a folder are listed
+#as not having submitted
+#The manifest is JSON if manifest_file ends in .json, and CSV otherwise
+def write_manifest(manifest_file, s_list, students = None,
+        verbose = False):
+    rows = []
+    for student_and_num in s_list:
+        rows.append((student_and_num[0], True))
+    if students is not None:
+        for key in sorted(students):
+            if not students[key].has_folder():
+                rows.append((students[key], False))
+    if manifest_file[-5:].lower() == ".json":
+        entries = []
+        for student, submitted in rows:
+            entries.append({"student": student.get_student_name(),
+                "folder": student.get_folder(),
+                "submitted": submitted,
+                "files": student.file_count,
+                "bytes": student.total_bytes,
+                "extensions": sorted(student.extensions)})
+        with open(manifest_file, 'w') as mfd:
+            json.dump(entries, mfd, indent = 1)
+    else:
+        with open(manifest_file, 'w', newline = '') as mfd:
+            writer = csv.writer(mfd)
+            writer.writerow(["student", "folder", "submitted", "files",
+                "bytes", "extensions"])
+            for student, submitted in rows:
+                if student.get_folder() is None:
+                    s_folder = ""
+                else:
+                    s_folder = student.get_folder()
+                writer.writerow([student.get_student_name(), s_folder,
+                    "yes" if submitted else "no", student.file_count,
+                    student.total_bytes,
+                    ' '.join(sorted(student.extensions))])
+    if verbose:
+        print()
+        print("Wrote manifest %s (%d students)"%(manifest_file, len(rows)))
+
+#Copy external files into the folder
+#The external files are always on the disk, even if the folder isn't
+def copy_external_files(folder, files, verbose = False):
+    if len(files) > 0 and verbose:
+        print()
+        print("Bringing in external files")
+    for external in files:
+        #Copy in the file
+        backend.copy_in(external, folder)
+        if verbose:
+            print("Copied in file %s"%external)
+
+#Get a hash of a file's contents, for shard_run_id
+#Files given on the command line are always on the disk
+def file_digest(path):
+    with open(path, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+#Get an ID for this run that every shard agrees on without talking to
+#the others: a hash of the options and of whose folders are in the
+#directory (which doesn't change when shards rename them)
+#Nothing in options should depend on where the shard is running from
+#(e.g. paths), only on what it's going to do
+#Shard files and the merge lock carry it, so files left over from a run
+#on other folders or with other options are never taken as this run's
+#(A shard file left by this same run means that shard already did its
+#part, since it's only written once the shard's renaming is done)
+def shard_run_id(folder, options):
+    keys = []
+    for itm in backend.scandir(folder):
+        if itm.is_dir() and (MOODLE_REGEX.match(itm.name) or\
+                RENAMED_REGEX.match(itm.name)):
+            keys.append(student_key(itm.name))
+    keys.sort()
+    return hashlib.sha1(repr((options, keys)).encode('utf-8')).hexdigest()
+
+#Record which student folders this shard ended up with, so that
+#whichever shard does the merge can flatten everybody's folders
+#The file is written under a temporary name and then renamed,
+#so other shards never see a half-written file
+def write_shard_file(folder, shard, run, s_list, verbose = False):
+    shard_file = folder + os.sep + SHARD_FILE%(shard[0] + 1, shard[1])
+    entries = []
+    for student_and_num in s_list:
+        student = student_and_num[0]
+        entries.append({"folder": student.get_folder(),
+            "dname": student_and_num[2],
+            "num": student_and_num[1],
+            "first": student.first,
+            "last": student.last})
+    with backend.open(shard_file + ".tmp", 'w') as sfd:
+        json.dump({"run": run, "entries": entries}, sfd)
+    backend.replace(shard_file + ".tmp", shard_file)
+    if verbose:
+        print("Wrote shard file %s"%shard_file)
+
+#Read every shard's file, if every shard of this run has written one
+#A shard file from a different run (other options or other folders)
+#is treated as missing, with a warning, since it will never be replaced
+#unless that shard is run again the same way as this one
+#Returns the list of each shard's entries, or None if any are missing
+def read_shard_files(folder, shard_count, run, verbose = False):
+    shard_entries = []
+    for i in range(shard_count):
+        shard_file = folder + os.sep + SHARD_FILE%(i + 1, shard_count)
+        try:
+            with backend.open(shard_file, 'r') as sfd:
+                contents = json.load(sfd)
+        except FileNotFoundError:
+            if verbose:
+                print("Shard file %s not found yet; leaving the merge to "
+                    "a later shard"%shard_file)
+            return None
+        except (OSError, ValueError):
+            contents = None
+        if not isinstance(contents, dict) or contents.get("run") != run:
+            print("Warning: shard file %s is from a different run (with "
+                "other options or folders); shard %d must be run again "
+                "the same way as this one before the merge can "
+                "happen"%(shard_file, i + 1))
+            return None
+        shard_entries.append(contents["entries"])
+    return shard_entries
+
+#Check whether every shard of this run is done, and if so, try to claim
+#the merge
+#The merge lock is created exclusively, so if several shards finish
+#at the same time, only one of them gets it; whoever gets it must
+#remove it when done, even if the merge fails
+#Returns True if this process got the lock
+def claim_merge(folder, shard_count, run, verbose = False):
+    #Are there shards still working?
+    if read_shard_files(folder, shard_count, run, verbose) is None:
+        return False
+    #Everybody is done; try to get the lock
+    lock = folder + os.sep + MERGE_LOCK
+    try:
+        with backend.open(lock, 'x') as lfd:
+            lfd.write("%s\n"%run)
+    except FileExistsError:
+        try:
+            with backend.open(lock, 'r') as lfd:
+                lock_run = lfd.read().strip()
+        except OSError:
+            lock_run = None
+        if lock_run == run:
+            print("Warning: merge lock %s already exists; another shard "
+                "is doing the merge"%lock)
+        else:
+            print("Warning: merge lock %s already exists, left by an "
+                "earlier run; delete it and run the shards again"%lock)
+        return False
+    return True
+
+#Collect every shard's folders for the merge, once claim_merge has
+#gotten the lock, and remove the shard files
+#The shard files are read again, since another shard may have done the
+#merge (and let go of the lock) between claim_merge reading them and
+#getting the lock
+#Returns the combined list of [student, student number, original folder
+#name], or None if the merge has already been done
+def merge_shards(folder, shard_count, run, students = None,
+        verbose = False):
+    shard_entries = read_shard_files(folder, shard_count, run, verbose)
+    if shard_entries is None:
+        return None
+    if verbose:
+        print()
+        print("Merging %d shards"%shard_count)
+    #Rebuild the full list of students
+    s_list = []
+    for entries in shard_entries:
+        for entry in entries:
+            #Use the student from the list, if there is one
+            if entry["num"] == 0:
+                key = entry["folder"] + '0'
+            else:
+                key = entry["folder"]
+            if students is not None and key in students:
+                student = students[key]
+            else:
+                student = Student(entry["first"], entry["last"],
+                    entry["first"])
+            student.assign_folder(entry["folder"])
+            s_list.append([student, entry["num"], entry["dname"]])
+    for i in range(shard_count):
+        backend.remove(folder + os.sep + SHARD_FILE%(i + 1, shard_count))
+    return s_list
 
 if __name__ == '__main__':
     ##Make sure there's a folder specified
@@ -314,6 +1718,9 @@ if __name__ == '__main__':
     students = None
     #Should we eliminate the folder structure?
     flatten = False
+    #How many levels of directories inside the student folders should
+    #we open up when flattening? (None means all of them)
+    depth = 0
     #What external files should we bring into the folder?
     files = set()
     #Are there any extensions where we should just make the
@@ -323,6 +1730,17 @@ if __name__ == '__main__':
     #with those extensions that indicate we actually don't want
     #to shorten those particular file names?
     protected_prefixes = set()
+    #Where should we write the manifest of who submitted what?
+    manifest = None
+    #Are we one of several processes splitting up the work?
+    #If so, this is (our index, number of processes)
+    shard = None
+    #Should we build a view somewhere else instead of changing things?
+    view = None
+    #Should the view use symbolic links instead of hard links?
+    symlink = False
+    #How many threads should unzip and flatten?
+    threads = 1
     #Should we print a bunch of stuff while this is running?
     verbose = False
 
@@ -372,6 +1790,28 @@ if __name__ == '__main__':
             flatten = True
             #Advance i by 1
             i += 1
+        elif flag in DEPTH_FLAGS:
+            #Depth specified to flatten to
+            if i + 1 == len(sys.argv):
+                #The depth flag was the last thing in the command,
+                #meaning no depth was specified
+                print("Error: Depth flag used without depth specified")
+                sys.exit(0)
+            elif sys.argv[i+1] == "all":
+                #Open up everything
+                depth = None
+                #Advance i by 2
+                i += 2
+            else:
+                try:
+                    depth = int(sys.argv[i+1])
+                except ValueError:
+                    depth = -1
+                if depth < 0:
+                    print("Error: Invalid depth: %s"%sys.argv[i+1])
+                    sys.exit(0)
+                #Advance i by 2
+                i += 2
         elif flag in EXTERNAL_FILE_FLAGS:
             #Bring in an external file
             if i + 1 == len(sys.argv):
@@ -419,6 +1859,94 @@ if __name__ == '__main__':
                 protected_prefixes.add(sys.argv[i+1])
                 #Advance i by 2
                 i += 2
+        elif flag in MANIFEST_FLAGS:
+            #Manifest file specified
+            if i + 1 == len(sys.argv):
+                #The manifest flag was the last thing in the command,
+                #meaning no file was specified
+                print("Error: Manifest flag used without file specified")
+                sys.exit(0)
+            else:
+                #Remember where to put it, in case we move around
+                manifest = os.path.abspath(sys.argv[i+1])
+                #Advance i by 2
+                i += 2
+        elif flag in SHARD_FLAGS:
+            #We are one of several processes
+            if shard is not None:
+                print("Error: Multiple shards specified")
+                sys.exit(0)
+            elif i + 1 == len(sys.argv):
+                #The shard flag was the last thing in the command,
+                #meaning no shard was specified
+                print("Error: Shard flag used without shard specified")
+                sys.exit(0)
+            else:
+                #Shard should look like k/N
+                shard_string = sys.argv[i+1].split('/')
+                try:
+                    shard = (int(shard_string[0]) - 1, int(shard_string[1]))
+                except (ValueError, IndexError):
+                    shard = None
+                if len(shard_string) != 2 or shard is None or\
+                        shard[0] < 0 or shard[0] >= shard[1]:
+                    print("Error: Invalid shard: %s"%sys.argv[i+1])
+                    sys.exit(0)
+                #Advance i by 2
+                i += 2
+        elif flag in VIEW_FLAGS:
+            #We should build a view
+            if view is not None:
+                print("Error: Multiple view directories specified")
+                sys.exit(0)
+            elif i + 1 == len(sys.argv):
+                #The view flag was the last thing in the command,
+                #meaning no directory was specified
+                print("Error: View flag used without directory specified")
+                sys.exit(0)
+            else:
+                view = os.path.abspath(sys.argv[i+1])
+                #The view can't be inside the directory, or we'd find it
+                #when looking for folders, and the directory can't be
+                #inside the view, or clearing out the view would delete it
+                #(following links, so that neither can sneak in that way)
+                real_folder = os.path.realpath(folder)
+                real_view = os.path.realpath(view)
+                if real_view == real_folder or\
+                        real_view[:len(real_folder) + 1] ==\
+                        real_folder + os.sep:
+                    print("Error: View directory can't be inside the "
+                        "directory to process")
+                    sys.exit(0)
+                elif real_folder[:len(real_view) + 1] == real_view + os.sep:
+                    print("Error: Directory to process can't be inside "
+                        "the view directory")
+                    sys.exit(0)
+                #Advance i by 2
+                i += 2
+        elif flag in SYMLINK_FLAGS:
+            #We should use symbolic links
+            symlink = True
+            #Advance i by 1
+            i += 1
+        elif flag in THREADS_FLAGS:
+            #Number of threads specified
+            if i + 1 == len(sys.argv):
+                #The threads flag was the last thing in the command,
+                #meaning no number was specified
+                print("Error: Threads flag used without number specified")
+                sys.exit(0)
+            else:
+                try:
+                    threads = int(sys.argv[i+1])
+                except ValueError:
+                    threads = 0
+                if threads < 1:
+                    print("Error: Invalid number of threads: %s"%\
+                        sys.argv[i+1])
+                    sys.exit(0)
+                #Advance i by 2
+                i += 2
         elif flag in VERBOSE_FLAGS:
             #We should print things
             verbose = True
@@ -429,347 +1957,124 @@ if __name__ == '__main__':
             display_help()
             sys.exit(0)
         else:
-            print("Invalid flag: "%flag)
+            print("Invalid flag: %s"%flag)
             print()
             display_help()
             sys.exit(0)
 
-    #Moodle folder regex
-    moodle_regex = re.compile("^\S* .*_\d*_assignsubmission_file_$")
-    renamed_regex = re.compile("^\S*_\S*$")
+    #Opening up directories is part of flattening
+    if depth != 0 and not flatten:
+        print("Error: Depth flag used without -f")
+        sys.exit(0)
 
-    #Get the list of folders
-    dirs = []
-    dnames = set()
-    s_list = []
-    #Scan the specified folder for directories
-    if verbose:
-        print("Scanning for Moodle download folders")
-    for itm in os.scandir(folder):
-        #Check if we're looking at a directory
-        if itm.is_dir():
-            #Yes
-            #Now, check if it's a directory from Moodle
-            if moodle_regex.match(itm.name):
-                #It is
-                if verbose:
-                    print("Found yet to be processed folder %s"%itm.name)
-                #Get the tokens before the first underscore
-                #and get the part after the underscore
-                uindex = itm.name.find(SEP)
-                sname = itm.name[:uindex].split()
-                #Figure out the corresponding student
-                if students is None:
-                    #Make one up
-                    #Assume first name is one word
-                    first = sname[0]
-                    last = SPACE.join(sname[1:])
-                    student = Student(first, last, first)
-                    student_num = 0
-                    while student.get_id_string(student_num) in dnames:
-                        #Need to increase student_num
-                        student_num += 1
-                else:
-                    #Check all possible parsings of the student's name
-                    student = None
-                    for split_loc in range(1, len(sname)):
-                        #Try a name
-                        try_student = Student(SPACE.join(sname[:split_loc]),\
-                            SPACE.join(sname[split_loc:]),\
-                            SPACE.join(sname[:split_loc]))
-                        done_trying = False
-                        #Loop in case there are multiple students
-                        #with the same name
-                        i = 0
-                        while True:
-                            #Does the student associated with this folder
-                            #actually exist?
-                            if "%s%d"%(str(try_student), i) not in students:
-                                break
-                            #Given yes, is it a duplicate that we've already
-                            #assigned before
-                            elif students["%s%d"%(str(try_student), i)].\
-                                    has_folder():
-                                i += 1
-                            #Ok, we're good to assign the folder
-                            else:
-                                student = students["%s%d"%(str(try_student),\
-                                    i)]
-                                student_num = i
-                                if verbose:
-                                    print("Folder belongs to student %s"%\
-                                        student.get_student_name())
-                                done_trying = True
-                                break
-                        if done_trying:
-                            break
-                    if student is None:
-                        #We failed to find a student
-                        print("Error: folder %s has no "
-                            "corresponding student"%itm.name)
-                        sys.exit(0)
-                #Keep track of the directory's name and its future name
-                new_name = student.get_id_string(student_num)
-                dirs.append((itm.name, new_name))
-                dnames.add(new_name)
-                student.assign_folder(new_name)
-                #Remember this student
-                s_list.append([student, student_num])
-                if verbose:
-                    print("Matching student %s to folder %s with number %d"%\
-                        (str(student), student.get_folder(), student_num))
-                #Unzip, if we want to do that
-                if unzip:
-                    unzip_zips(folder + os.sep + itm.name, verbose)
-            #Next, check if it's already been renamed by our program
-            elif renamed_regex.match(itm.name):
-                #It is
-                if verbose:
-                    print("Found already renamed folder %s"%itm.name)
-                sname = itm.name.split(SEP + SEP)
-                #Make up a student
-                first = sname[1]
-                #remove numbers from end of first
-                while ord(first[-1]) >= ord('0') and\
-                        ord(first[-1]) <= ord('9'):
-                    first = first[:-1]
-                #Student's number
-                student_num = 0
-                if first != sname[1]:
-                    student_num = int(sname[1][len(first):])
-                #Last name
-                last = sname[0]
-                try_student = Student(first, last, first)
-                #Figure out the corresponding student
-                if students is None:
-                    #Make one up
-                    student = try_student
-                elif itm.name + '0' in students:
-                    #Default student, no repeatss
-                    student = students[itm.name + '0']
-                elif itm.name not in students:
-                    print("Error: folder %s has no "
-                        "corresponding student"%itm.name)
-                    sys.exit(0)
-                else:
-                    student = students[itm.name]
-                #Keep track of the directory's name
-                dnames.add(itm.name)
-                student.assign_folder(itm.name)
-                #Remember this student
-                s_list.append([student, student_num])
-                if verbose:
-                    print("Matching student %s to folder %s with number %d"%\
-                        (str(student), student.get_folder(), student_num))
-                #Unzip, if we want to do that
-                if unzip:
-                    unzip_zips(folder + os.sep + itm.name, verbose)
-    #Rename the folders
-    if verbose:
-        print()
-        print("Renaming folders")
-    #Loop through the directories needing renaming
-    for dirc in dirs:
-        #Do the renaming
-        os.rename(folder + os.sep + dirc[0], folder + os.sep + dirc[1])
-        if verbose:
-            print("Renamed %s to %s"%(dirc[0], dirc[1]))
-    if verbose:
-        print("Done renaming")
+    #Where the results go: the folder itself, or the view
+    if view is None:
+        target = folder
+    else:
+        target = view
+        #Get the view ready
+        try:
+            prepare_view(view, shard is None, verbose)
+        except ValueError as e:
+            print(e.args[0])
+            sys.exit(0)
+
+    #Flatten/Shorten/Exemption
+    #If we're one of several processes, whoever does the merge
+    #flattens everything instead
+    if flatten and shard is None:
+        if view is None or unzip:
+            flattener = Flattener(target, shorten_extensions,
+                protected_prefixes, depth, manifest is not None, verbose)
+        else:
+            flattener = Flattener(view, shorten_extensions,
+                protected_prefixes, depth, manifest is not None, verbose,
+                folder, symlink)
+    else:
+        flattener = None
 
-    #Folders prefixes
-    if flatten and len(shorten_extensions) > 0:
+    #If we're one of several processes, figure out which run this is,
+    #before anybody starts renaming things
+    if shard is not None:
+        #Files are identified by their names and contents, not where
+        #they are, since shards may be run from different places
+        if students is None:
+            students_digest = None
+        else:
+            students_digest = file_digest(student_file)
+        if manifest is None:
+            manifest_name = None
+        else:
+            manifest_name = os.path.basename(manifest)
+        run = shard_run_id(folder, (shard[1], students_digest, unzip,
+            flatten, depth, sorted([(os.path.basename(external),
+            file_digest(external)) for external in files]),
+            sorted(shorten_extensions), sorted(protected_prefixes),
+            manifest_name, view is not None, symlink))
         if verbose:
-            print()
-            print("Figuring out shortened names")
-        #List the folders
-        folder_list = [sn[0].get_folder() for sn in s_list]
-        #Sort the list of folders
-        folder_list.sort()
-        #Look for optimal prefixes
-        folder_prefixes = dict()
-        lnames = dict()
-        #First, group everybody by last name
-        i = 0
-        while i < len(folder_list):
-            fldr = folder_list[i]
-            #Look for people with the SAME name
-            j = i + 1
-            while j < len(folder_list) and\
-                    folder_list[j][:len(fldr)] == fldr:
-                j += 1
-            #Figure out the current last name
-            lname = fldr[:folder_list[i].find(SEP)]
-            if lname not in lnames:
-                lnames[lname] = []
-            #Create an entry, keeping track of the number of people
-            #with that name
-            lnames[lname].append((fldr, j - i))
-            if verbose:
-                print("Name %s; last name %s; %d people"%(fldr, lname, j - i))
-            #Advance to the next unique name
-            i = j
-        #Now, go through and find unique prefixes
-        for lname in lnames:
-            if verbose:
-                print("Now considering last name %s"%lname)
-            #Loop through the names with that last name
-            for i in range(len(lnames[lname])):
-                #Get the folder name and count,
-                #and the index after the last name
-                fldr = lnames[lname][i][0]
-                ct = lnames[lname][i][1]
-                idx = fldr.find(SEP)
-                #Extend the prefix until it's unique
-                while True:
-                    ok = True
-                    #What's the current prefix?
-                    name = fldr[:idx]
-                    #Check to see if it's unique?
-                    for j in range(len(lnames[lname])):
-                        if i != j and lnames[lname][j][0][:idx] == name:
-                            #It's not
-                            ok = False
-                            break
-                    if ok:
-                        if verbose:
-                            print("Found unique prefix %s"%name)
-                        #Prefix was unique
-                        #Let's roll with it
-                        folder_prefixes[fldr] = name
-                        #In case there were multiple people with the same name
-                        #Need to account for all of them
-                        for j in range(1, ct):
-                            folder_prefixes[fldr + str(j)] = name + str(j)
-                        if verbose:
-                            print("Updated %d entries"%ct)
-                        break
-                    else:
-                        #Try again with a longer prefix
-                        idx += 1
-        #Remove underscores from shortened names
-        for fldr in folder_prefixes:
-            folder_prefixes[fldr] = folder_prefixes[fldr].replace(SEP, "")
+            print("Shard %d of %d; run %s"%(shard[0] + 1, shard[1], run))
+
+    #Find and match the folders, unzipping, renaming, and flattening
+    #them as we go
+    try:
+        s_list = run_pipeline(folder, students, unzip, shard, flattener,
+            manifest is not None and not flatten and shard is None,
+            threads, verbose, view, symlink, flatten)
+    except ValueError as e:
+        #A folder didn't match anybody
+        print(e.args[0])
+        sys.exit(0)
+
+    #If we're one of several processes, hand our folders off to
+    #whoever does the merge
+    if shard is not None:
+        write_shard_file(target, shard, run, s_list, verbose)
+        if not claim_merge(target, shard[1], run, verbose):
+            #Somebody else will finish up
             if verbose:
-                print("Prefix for %s changed to %s"%(fldr,\
-                    folder_prefixes[fldr]))
+                print()
+                print("Done!")
+            sys.exit(0)
 
-    #Flatten/Shorten/Exemption
-    #This works even if you've already done the rest
-    if flatten:
-        if verbose:
-            print()
-            print("Flattening")
-        for student_and_num in s_list:
-            student = student_and_num[0]
-            student_num = student_and_num[1]
-            #Get the student's folder
-            s_folder = student.get_folder()
-            #Files to move
-            move_files = []
-            for in_itm in os.scandir(folder + os.sep + s_folder):
-                #Tag file for moving
-                move_files.append(in_itm)
+    #If we're one of several processes, everything from here on is the
+    #merge, and the lock has to go away afterwards, even if something
+    #goes wrong, so that the next run can merge
+    try:
+        if shard is not None:
+            s_list = merge_shards(target, shard[1], run, students, verbose)
+            if s_list is None:
+                #Somebody else already finished up
                 if verbose:
-                    print("File/directory %s tagged for moving"%in_itm.name)
-            for move_file in move_files:
-                #Make the new name
-                if student_num == 0:
-                    new_name = s_folder + SEP + move_file.name
-                else:
-                    new_name = student.last.replace(" ", SEP) +\
-                        str(student_num) + SEP + SEP +\
-                        student.first.replace(" ", SEP) + SEP + move_file.name
-                #Check if need to shorten filename
-                for ext in shorten_extensions:
-                    if move_file.name[-len(ext):] == ext:
-                        if verbose:
-                            print("File %s has extension %s"%\
-                                (move_file.name, ext))
-                        #We've matched an extension to shorten
-                        #Check if we need to actually not shorten it
-                        protected = False
-                        for pre in protected_prefixes:
-                            if move_file.name[:len(pre)] == pre:
-                                #We actually need to not shorten it
-                                protected = True
-                                if verbose:
-                                    print("File %s has protected prefix %s"%\
-                                        (move_file.name, pre))
-                                break
-                        if not protected:
-                            #Do the rename
-                            #Use the prefix created earlier
-                            new_name = folder_prefixes[s_folder] + ext
-                            if verbose:
-                                print("File %s tagged for renaming to %s"%\
-                                    (move_file.name, new_name))
-                        break
-                #Check if the file already exists
-                if os.path.isfile(folder + os.sep + new_name):
-                    if verbose:
-                        print("File %s already exists"%new_name)
-                    #Append a number to make it not already exist
-                    dot_index = new_name.rfind(".")
-                    #If there is no dot, we'll add numbers to the end
-                    if dot_index == -1:
-                        dot_index = len(new_name)
-                    #Ignore files that start with dot
-                    if dot_index != 0:
-                        #Loop until we find an available name
-                        i = 0
-                        while os.path.isfile(folder + os.sep +\
-                                new_name[:dot_index] + SEP + str(i) +\
-                                new_name[dot_index:]):
-                            i += 1
-                        #Use the available name
-                        new_name = new_name[:dot_index] + SEP + str(i) +\
-                            new_name[dot_index:]
-                        if verbose:
-                            print("Instead using name %s"%new_name)
-                #Check if we should ignore the file
-                ignore = False
-                for ig in IGNORE:
-                    if move_file.name[:len(ig)] == ig:
-                        ignore = True
-                        break
-                if ignore:
-                    #Delete the thing
-                    if os.path.isfile(folder + os.sep + s_folder + os.sep +\
-                            move_file.name):
-                        os.remove(folder + os.sep + s_folder + os.sep +\
-                            move_file.name)
-                        if verbose:
-                            print("Deleted irrelevant file: %s"%move_file.name)
-                    else:
-                        shutil.rmtree(folder + os.sep + s_folder + os.sep +\
-                            move_file.name)
-                        if verbose:
-                            print("Deleted irrelevant directory: %s"%new_dirc)
+                    print()
+                    print("Done!")
+                sys.exit(0)
+            if flatten:
+                if view is None or unzip:
+                    flattener = Flattener(target, shorten_extensions,
+                        protected_prefixes, depth, manifest is not None,
+                        verbose)
                 else:
-                    #Prepare to move
-                    new_name = folder + os.sep + new_name
-                    #Move the file
-                    os.rename(folder + os.sep + s_folder + os.sep +\
-                        move_file.name, new_name)
-                    if verbose:
-                        print("Renamed file/directory %s to %s"%\
-                            (folder + os.sep + s_folder + os.sep +\
-                            move_file.name, new_name))
-            #Remove the directory
-            shutil.rmtree(folder + os.sep + s_folder)
-            if verbose:
-                print("Removed directory %s"%s_folder)
+                    flattener = Flattener(view, shorten_extensions,
+                        protected_prefixes, depth, manifest is not None,
+                        verbose, folder, symlink)
+                #Folders prefixes
+                if flattener.needs_prefixes():
+                    flattener.set_prefixes(find_folder_prefixes(
+                        [sn[0].get_folder() for sn in s_list], verbose))
+                flatten_folders(flattener, s_list, threads, verbose)
+            elif manifest is not None:
+                count_files(target, s_list, threads, verbose)
 
-    #Bring in external files
-    if len(files) > 0 and verbose:
-        print()
-        print("Bringing in external files")
-    for external in files:
-        #Copy in the file
-        shutil.copy2(external, folder)
-        if verbose:
-            print("Copied in file %s"%external)
+        #Bring in external files
+        copy_external_files(target, files, verbose)
+
+        #Write out the manifest
+        if manifest is not None:
+            write_manifest(manifest, s_list, students, verbose)
+    finally:
+        #The merge is finished, so the next run can use the lock again
+        if shard is not None:
+            backend.remove(target + os.sep + MERGE_LOCK)
 
     if verbose:
         print()
@@ -0,0 +1,586 @@
+import os
+import sys
+import csv
+import json
+import shutil
+import tempfile
+import zipfile
+import subprocess
+import unittest
+
+#Let the tests import renamefolders.py from the directory above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import renamefolders
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "renamefolders.py")
+
+#Make a directory of Moodle-style submission folders to work on
+#Returns the students' names, as (first, last) pairs
+def make_submissions(root):
+    firsts = ["John", "Mary Ann", "Bob", "Alice", "Eve"]
+    lasts = ["Smith", "Jones", "Spencer Evans", "Lee"]
+    os.makedirs(root)
+    names = []
+    for k in range(20):
+        names.append((firsts[k%len(firsts)], lasts[k//len(firsts)]))
+        dname = os.path.join(root, "%s %s_%d_assignsubmission_file_"%(
+            names[-1][0], names[-1][1], 1000 + k))
+        os.makedirs(dname)
+        with open(os.path.join(dname, "hw.py"), 'w') as fd:
+            fd.write("print(%d)\n"%k)
+        with open(os.path.join(dname, "notes.txt"), 'w') as fd:
+            fd.write("x"*k)
+        if k%3 == 0:
+            with zipfile.ZipFile(os.path.join(dname, "proj.zip"), 'w') as zfd:
+                zfd.writestr("proj/src/Main.java", "class Main{}%d"%k)
+                zfd.writestr("proj/README", "r")
+                zfd.writestr("proj/main.py", "print('main %d')\n"%k)
+    return names
+
+#Everything under a directory, as {relative path: file contents}
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            with open(path, 'rb') as fd:
+                tree[os.path.relpath(path, root)] = fd.read()
+        for dname in dirnames:
+            tree[os.path.relpath(os.path.join(dirpath, dname), root)] = None
+    return tree
+
+#Run the script on a directory, from cwd if given
+def run_script(folder, *args, cwd = None):
+    return subprocess.run([sys.executable, SCRIPT, folder] + list(args),
+        stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+        universal_newlines = True, check = True, cwd = cwd).stdout
+
+#Tests for find_folder_prefixes
+class TestFolderPrefixes(unittest.TestCase):
+    #Only person with a last name just gets the last name
+    def test_unique_last_name(self):
+        self.assertEqual(renamefolders.find_folder_prefixes(["Jo__Bo"]),
+            {"Jo__Bo": "Jo"})
+
+    #Prefixes go just far enough to tell people apart
+    def test_shared_last_name(self):
+        self.assertEqual(renamefolders.find_folder_prefixes(
+            ["Smith__Alice", "Smith__Bob", "Smith__Bea"]),
+            {"Smith__Alice": "SmithA", "Smith__Bob": "SmithBo",
+            "Smith__Bea": "SmithBe"})
+
+    #People with the same name share a prefix, plus their number
+    def test_same_name(self):
+        self.assertEqual(renamefolders.find_folder_prefixes(
+            ["Smith__Ann", "Smith__Ann1", "Smith__Bob"]),
+            {"Smith__Ann": "SmithA", "Smith__Ann1": "SmithA1",
+            "Smith__Bob": "SmithB"})
+
+    #A name that starts another name (Ann and Anna) is not the same name,
+    #and gets the whole name as its prefix
+    def test_name_starting_another(self):
+        self.assertEqual(renamefolders.find_folder_prefixes(
+            ["Smith__Ann", "Smith__Anna", "Smith__Ann1", "Smith__Bob"]),
+            {"Smith__Ann": "SmithAnn", "Smith__Ann1": "SmithAnn1",
+            "Smith__Anna": "SmithAnna", "Smith__Bob": "SmithB"})
+
+    #Names that are the same once the underscores are taken out still
+    #get different prefixes
+    def test_name_then_underscore(self):
+        self.assertEqual(renamefolders.find_folder_prefixes(
+            ["Li__Mary", "Li__Mary_Ann"]),
+            {"Li__Mary": "LiMary", "Li__Mary_Ann": "LiMaryA"})
+        prefixes = renamefolders.find_folder_prefixes(
+            ["Li__Mary", "Li__Ma_ry", "Li__Bo"])
+        self.assertEqual(len(set(prefixes.values())), 3)
+        self.assertEqual(prefixes["Li__Bo"], "LiB")
+
+#Tests for failures partway through
+class TestFailures(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, "folder")
+        self.names = make_submissions(self.folder)
+        self.before = sorted(os.listdir(self.folder))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    #A folder with no student stops everything before anything is
+    #renamed or flattened
+    def test_missing_student(self):
+        roster = os.path.join(self.tmp, "roster")
+        with open(roster, 'w') as fd:
+            for first, last in self.names[:-1]:
+                fd.write("%s %s\n"%(first.replace(" ", "~"),
+                    last.replace(" ", "~")))
+        output = run_script(self.folder, "-s", roster, "-z", "-f", "-x",
+            ".py", "-t", "4")
+        self.assertIn("has no corresponding student", output)
+        self.assertEqual(sorted(os.listdir(self.folder)), self.before)
+
+    #A bad ZIP file stops everything from going any further with its
+    #folder (or any folder not already started on)
+    def test_bad_zip(self):
+        bad = os.path.join(self.folder, self.before[-1], "bad.zip")
+        with open(bad, 'w') as fd:
+            fd.write("not a zip file")
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_script(self.folder, "-z", "-f", "-x", ".py", "-t", "4")
+        self.assertTrue(os.path.isfile(bad))
+
+#Tests for opening up directories with -d
+class TestDepth(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, "folder")
+        student = os.path.join(self.folder,
+            "Ann Lee_1000_assignsubmission_file_")
+        for path, contents in [(("proj", "src", "main", "Main.java"), "m"),
+                (("src_x.txt",), "flat"), (("src", "x.txt"), "nested")]:
+            os.makedirs(os.path.join(student, *path[:-1]), exist_ok = True)
+            with open(os.path.join(student, *path), 'w') as fd:
+                fd.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    #By default, directories are moved as they are
+    def test_default(self):
+        run_script(self.folder, "-f")
+        tree = read_tree(self.folder)
+        self.assertEqual(tree[os.path.join("Lee__Ann_proj", "src", "main",
+            "Main.java")], b"m")
+        self.assertEqual(tree[os.path.join("Lee__Ann_src", "x.txt")],
+            b"nested")
+        self.assertEqual(tree["Lee__Ann_src_x.txt"], b"flat")
+
+    #One level opened up, and the names of the directories put on the
+    #front; src_x.txt and src/x.txt collide, so one gets a number
+    def test_one_level(self):
+        run_script(self.folder, "-f", "-d", "1")
+        tree = read_tree(self.folder)
+        self.assertEqual(tree[os.path.join("Lee__Ann_proj_src", "main",
+            "Main.java")], b"m")
+        self.assertEqual(sorted([tree["Lee__Ann_src_x.txt"],
+            tree["Lee__Ann_src_x_0.txt"]]), [b"flat", b"nested"])
+        self.assertNotIn("Lee__Ann_src", tree)
+
+    #Everything opened up
+    def test_all(self):
+        run_script(self.folder, "-f", "-d", "all")
+        tree = read_tree(self.folder)
+        self.assertEqual(tree["Lee__Ann_proj_src_main_Main.java"], b"m")
+        self.assertEqual(sorted(tree), sorted(["Lee__Ann_proj_src_main_"
+            "Main.java", "Lee__Ann_src_x.txt", "Lee__Ann_src_x_0.txt"]))
+
+    #Depth without flattening is a mistake
+    def test_without_flatten(self):
+        before = read_tree(self.folder)
+        output = run_script(self.folder, "-d", "1")
+        self.assertIn("without -f", output)
+        self.assertEqual(read_tree(self.folder), before)
+
+#Tests for the manifest written with -m
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, "folder")
+        names = make_submissions(self.folder)
+        self.roster = os.path.join(self.tmp, "roster")
+        with open(self.roster, 'w') as fd:
+            for first, last in names + [("Zed", "Nobody")]:
+                fd.write("%s %s\n"%(first.replace(" ", "~"),
+                    last.replace(" ", "~")))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    #Files, bytes, and extensions in each student's folder, by folder
+    def count_tree(self, root):
+        counts = {}
+        for dname in os.listdir(root):
+            files = 0
+            size = 0
+            extensions = set()
+            for dirpath, dirnames, filenames in\
+                    os.walk(os.path.join(root, dname)):
+                for fname in filenames:
+                    files += 1
+                    size += os.path.getsize(os.path.join(dirpath, fname))
+                    if len(os.path.splitext(fname)[1]) > 0:
+                        extensions.add(os.path.splitext(fname)[1])
+            counts[dname] = (files, size, sorted(extensions))
+        return counts
+
+    #Copy the folder, run the script on the copy, and read the manifest
+    def run_manifest(self, name, *options):
+        folder = os.path.join(self.tmp, name)
+        shutil.copytree(self.folder, folder, symlinks = True)
+        manifest = os.path.join(self.tmp, name + ".json")
+        run_script(folder, "-s", self.roster, "-m", manifest, *options)
+        with open(manifest, 'r') as fd:
+            return folder, {entry["folder"]: entry\
+                for entry in json.load(fd)}
+
+    #Without -f, counts match what's in each renamed folder, and the
+    #student who didn't submit is listed too
+    def test_json(self):
+        folder, entries = self.run_manifest("plain")
+        self.assertFalse(entries[None]["submitted"])
+        self.assertEqual(entries[None]["student"], "Zed Nobody")
+        del entries[None]
+        self.assertEqual({name: (entry["files"], entry["bytes"],
+            entry["extensions"]) for name, entry in entries.items()},
+            self.count_tree(folder))
+        self.assertTrue(all(entry["submitted"]\
+            for entry in entries.values()))
+        self.assertIn(".zip", entries["Smith__John"]["extensions"])
+
+    #Flattening counts the same files as counting without flattening,
+    #both after unzipping, and so does the merge with -n
+    def test_flatten_and_shards(self):
+        folder, counted = self.run_manifest("counted", "-z")
+        expected = self.count_tree(folder)
+        flat_folder, flattened = self.run_manifest("flattened", "-z", "-f")
+        self.assertEqual(flattened, counted)
+        sharded = os.path.join(self.tmp, "sharded")
+        shutil.copytree(self.folder, sharded)
+        manifest = os.path.join(self.tmp, "sharded.json")
+        for i in range(3):
+            run_script(sharded, "-s", self.roster, "-m", manifest, "-z",
+                "-f", "-n", "%d/3"%(i + 1))
+        with open(manifest, 'r') as fd:
+            self.assertEqual({entry["folder"]: entry\
+                for entry in json.load(fd)}, counted)
+        del counted[None]
+        self.assertEqual({name: (entry["files"], entry["bytes"],
+            entry["extensions"]) for name, entry in counted.items()},
+            expected)
+        self.assertNotIn(".zip", counted["Smith__John"]["extensions"])
+
+    #CSV has the same things, with a header
+    def test_csv(self):
+        manifest = os.path.join(self.tmp, "manifest.csv")
+        run_script(self.folder, "-s", self.roster, "-m", manifest)
+        counts = self.count_tree(self.folder)
+        with open(manifest, 'r', newline = '') as fd:
+            rows = list(csv.reader(fd))
+        self.assertEqual(rows[0], ["student", "folder", "submitted",
+            "files", "bytes", "extensions"])
+        self.assertIn(["Zed Nobody", "", "no", "0", "0", ""], rows[1:])
+        for row in rows[1:]:
+            if row[1] != "":
+                self.assertEqual(row[2], "yes")
+                self.assertEqual((int(row[3]), int(row[4]),
+                    row[5].split()), counts[row[1]])
+        self.assertEqual(len(rows), len(counts) + 2)
+
+    #A broken link in a submission is counted, not a crash
+    def test_broken_link(self):
+        folder, plain = self.run_manifest("plain")
+        dname = sorted(os.listdir(self.folder))[0]
+        os.symlink(os.path.join(self.tmp, "missing"),
+            os.path.join(self.folder, dname, "broken.txt"))
+        folder, entries = self.run_manifest("broken")
+        self.assertEqual(sum(entry["files"] for entry in entries.values()),
+            sum(entry["files"] for entry in plain.values()) + 1)
+
+#Tests for extracting ZIP files
+class TestExtractZip(unittest.TestCase):
+    #Names are cleaned up as extractall would on Windows
+    def test_windows_names(self):
+        self.assertEqual(renamefolders.zip_member_parts(
+            "a/..\\..\\evil.py", '\\', '/'), ["a", "evil.py"])
+        self.assertEqual(renamefolders.zip_member_parts(
+            "C:\\x\\y:z?.py.", '\\', '/'), ["x", "y_z_.py"])
+
+    #Nothing ends up outside the directory being extracted into
+    def test_stays_inside(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            dirc = os.path.join(tmp, "a", "b")
+            os.makedirs(dirc)
+            zip_file = os.path.join(tmp, "evil.zip")
+            with zipfile.ZipFile(zip_file, 'w') as zfd:
+                zfd.writestr("../../evil.py", "evil")
+                zfd.writestr("/abs/x.py", "x")
+            with zipfile.ZipFile(zip_file, 'r') as zfd:
+                renamefolders.extract_zip(zfd, dirc)
+            self.assertEqual(sorted(read_tree(os.path.join(tmp, "a"))),
+                sorted(["b", os.path.join("b", "evil.py"),
+                os.path.join("b", "abs"), os.path.join("b", "abs", "x.py")]))
+        finally:
+            shutil.rmtree(tmp)
+
+#Tests for the pipeline's stages
+class TestStage(unittest.TestCase):
+    #Something going wrong in one stage stops every stage from taking on
+    #anything new
+    def test_error_cancels_everything(self):
+        done = []
+        def fail_on_two(item):
+            if item == 2:
+                raise ValueError("two")
+        last = renamefolders.Stage(done.append)
+        first = renamefolders.Stage(fail_on_two, 1, last)
+        for item in range(5):
+            first.put(item)
+        first.close()
+        self.assertIsInstance(first.error, ValueError)
+        self.assertTrue(last.cancel.is_set())
+        self.assertNotIn(2, done)
+        self.assertNotIn(3, done)
+        self.assertNotIn(4, done)
+
+#Tests for running as several processes with -n
+class TestShards(unittest.TestCase):
+    OPTIONS = ["-z", "-f", "-x", ".py"]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.single = os.path.join(self.tmp, "single")
+        self.sharded = os.path.join(self.tmp, "sharded")
+        make_submissions(self.single)
+        shutil.copytree(self.single, self.sharded)
+        run_script(self.single, *self.OPTIONS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    #Start every shard at once and wait for all of them
+    def run_shards(self, count, *options):
+        procs = [subprocess.Popen([sys.executable, SCRIPT, self.sharded,
+            "-n", "%d/%d"%(i + 1, count)] + self.OPTIONS + list(options),
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+            universal_newlines = True) for i in range(count)]
+        outputs = [proc.communicate()[0] for proc in procs]
+        for proc, output in zip(procs, outputs):
+            self.assertEqual(proc.returncode, 0, output)
+        return outputs
+
+    #N processes together end up with the same folder as one process
+    def test_matches_single_process(self):
+        self.run_shards(4)
+        self.assertEqual(read_tree(self.sharded), read_tree(self.single))
+
+    #The same goes with several threads each, including for the merge
+    def test_matches_single_process_threads(self):
+        self.run_shards(3, "-t", "4")
+        self.assertEqual(read_tree(self.sharded), read_tree(self.single))
+
+    #A merge lock left behind by a failed run blocks the merge, with a
+    #warning, rather than being ignored
+    def test_stale_lock(self):
+        lock = os.path.join(self.sharded, renamefolders.MERGE_LOCK)
+        with open(lock, 'w') as fd:
+            fd.write("some other run\n")
+        outputs = self.run_shards(2)
+        self.assertTrue(any("Warning" in output for output in outputs))
+        self.assertNotEqual(read_tree(self.sharded), read_tree(self.single))
+
+    #A shard file left behind by a run on other folders isn't taken as
+    #one of this run's shards
+    def test_stale_shard_file(self):
+        stale = os.path.join(self.sharded,
+            renamefolders.SHARD_FILE%(2, 2))
+        with open(stale, 'w') as fd:
+            fd.write('{"run": "some other run", "entries": []}')
+        output = run_script(self.sharded, "-n", "1/2", *self.OPTIONS)
+        #Shard 1 can't merge yet, since shard 2 hasn't run, and says so
+        self.assertTrue(os.path.exists(stale))
+        self.assertIn("from a different run", output)
+        run_script(self.sharded, "-n", "2/2", *self.OPTIONS)
+        self.assertEqual(read_tree(self.sharded), read_tree(self.single))
+
+    #Shards started from different places, with the same files given by
+    #different paths, are still the same run
+    def test_paths_as_typed(self):
+        with open(os.path.join(self.tmp, "ext.py"), 'w') as fd:
+            fd.write("external\n")
+        single = os.path.join(self.tmp, "single_ext")
+        shutil.rmtree(self.single)
+        make_submissions(single)
+        run_script(single, "-e", "ext.py", *self.OPTIONS, cwd = self.tmp)
+        run_script(self.sharded, "-n", "1/2", "-e", "ext.py",
+            *self.OPTIONS, cwd = self.tmp)
+        run_script(self.sharded, "-n", "2/2", "-e",
+            os.path.join(self.tmp, "ext.py"), *self.OPTIONS,
+            cwd = self.sharded)
+        self.assertEqual(read_tree(self.sharded), read_tree(single))
+
+    #A shard that got the lock after another shard already merged and
+    #let go of it finds the shard files gone, and does nothing
+    def test_merge_already_done(self):
+        names = [(renamefolders.Student("Ann", "Lee", "Ann"), 0,
+            "Ann Lee_1_assignsubmission_file_")]
+        names[0][0].assign_folder("Lee__Ann")
+        for i in range(2):
+            renamefolders.write_shard_file(self.sharded, (i, 2), "run",
+                names[:1 - i])
+        self.assertTrue(renamefolders.claim_merge(self.sharded, 2, "run"))
+        self.assertFalse(renamefolders.claim_merge(self.sharded, 2, "run"))
+        s_list = renamefolders.merge_shards(self.sharded, 2, "run")
+        self.assertEqual([sn[0].get_folder() for sn in s_list],
+            ["Lee__Ann"])
+        os.remove(os.path.join(self.sharded, renamefolders.MERGE_LOCK))
+        self.assertFalse(renamefolders.claim_merge(self.sharded, 2, "run"))
+        self.assertIsNone(renamefolders.merge_shards(self.sharded, 2, "run"))
+
+#Tests for building a view with -w
+class TestView(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, "folder")
+        self.view = os.path.join(self.tmp, "view")
+        make_submissions(self.folder)
+        self.before = read_tree(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    #A view can't hold the directory being processed, since building
+    #the view clears out what was there from the last time
+    def test_folder_inside_view(self):
+        view = os.path.join(self.tmp, "outer")
+        inner = os.path.join(view, "submissions")
+        os.makedirs(view)
+        with open(os.path.join(view, renamefolders.VIEW_MARKER), 'w') as fd:
+            fd.write("old view\n")
+        shutil.move(self.folder, inner)
+        for options in [["-w", view], ["-w", inner + os.sep + os.pardir]]:
+            output = run_script(inner, *options)
+            self.assertIn("can't be inside the view", output)
+            self.assertEqual(read_tree(inner), self.before)
+
+    #Adding to a directory in a view doesn't add to the original,
+    #with hard links or symbolic links
+    def test_view_directories_are_separate(self):
+        dname = sorted(os.listdir(self.folder))[0]
+        os.makedirs(os.path.join(self.folder, dname, "src"))
+        with open(os.path.join(self.folder, dname, "src", "x.py"),
+                'w') as fd:
+            fd.write("x")
+        before = read_tree(self.folder)
+        for options in [[], ["-l"]]:
+            run_script(self.folder, "-f", "-w", self.view, *options)
+            src = [name for name in os.listdir(self.view)\
+                if name.endswith("src")]
+            self.assertEqual(len(src), 1)
+            with open(os.path.join(self.view, src[0], "new.txt"),
+                    'w') as fd:
+                fd.write("new")
+            self.assertEqual(read_tree(self.folder), before)
+
+    #A flattened view as a single shard leaves everything to the merge
+    def test_flatten_one_shard(self):
+        run_script(self.folder, "-f", "-w", self.view, "-n", "1/1")
+        self.assertEqual(read_tree(self.folder), self.before)
+        self.assertIn("Smith__John_hw.py", os.listdir(self.view))
+
+    #A view ends up the same as changing the folder itself, including
+    #which of two files given the same shortened name gets the number
+    def test_same_as_in_place(self):
+        in_place = os.path.join(self.tmp, "in_place")
+        shutil.copytree(self.folder, in_place)
+        run_script(in_place, "-z", "-f", "-x", ".py")
+        for options in [[], ["-l"]]:
+            run_script(self.folder, "-z", "-f", "-x", ".py", "-w",
+                self.view, *options)
+            self.assertEqual(read_tree(self.folder), self.before)
+            view = read_tree(self.view)
+            del view[renamefolders.VIEW_MARKER]
+            self.assertEqual(view, read_tree(in_place))
+
+#Copy a directory on the disk into a MemoryBackend
+def load_tree(fs, root, dest):
+    fs.makedirs(dest)
+    for itm in os.scandir(root):
+        if itm.is_dir():
+            load_tree(fs, itm.path, dest + os.sep + itm.name)
+        else:
+            with open(itm.path, 'rb') as sfd, fs.open(dest + os.sep +\
+                    itm.name, 'wb') as dfd:
+                dfd.write(sfd.read())
+
+#Everything under a directory in a MemoryBackend, as read_tree gives it
+def read_memory_tree(fs, root, prefix = ""):
+    tree = {}
+    for itm in fs.scandir(root):
+        if itm.is_dir():
+            tree[prefix + itm.name] = None
+            tree.update(read_memory_tree(fs, itm.path,
+                prefix + itm.name + os.sep))
+        else:
+            with fs.open(itm.path, 'rb') as fd:
+                tree[prefix + itm.name] = fd.read()
+    return tree
+
+#Tests for running the pipeline on a MemoryBackend
+class TestMemoryBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, "folder")
+        make_submissions(self.folder)
+        self.external = os.path.join(self.tmp, "external.txt")
+        with open(self.external, 'w') as fd:
+            fd.write("external")
+        self.fs = renamefolders.MemoryBackend()
+        load_tree(self.fs, self.folder, os.sep + "course")
+        self.disk_backend = renamefolders.backend
+        renamefolders.backend = self.fs
+
+    def tearDown(self):
+        renamefolders.backend = self.disk_backend
+        shutil.rmtree(self.tmp)
+
+    #Unzipping, flattening, and bringing in an external file in memory
+    #ends up the same as on the disk
+    def test_same_as_disk(self):
+        course = os.sep + "course"
+        flattener = renamefolders.Flattener(course, count = True)
+        s_list = renamefolders.run_pipeline(course, unzip = True,
+            flattener = flattener, threads = 4)
+        renamefolders.copy_external_files(course, {self.external})
+        self.assertEqual(len(s_list), 20)
+        self.assertEqual(sum(sn[0].file_count for sn in s_list), 61)
+        run_script(self.folder, "-z", "-f", "-e", self.external)
+        self.assertEqual(read_memory_tree(self.fs, course),
+            read_tree(self.folder))
+
+    #Symbolic links in memory point at the original, as on the disk
+    def test_symlinks_are_aliases(self):
+        self.fs.makedirs(os.sep + "a" + os.sep + "dir")
+        self.fs.symlink(os.sep + "a" + os.sep + "dir", os.sep + "link")
+        with self.fs.open(os.sep + "link" + os.sep + "new.txt", 'w') as fd:
+            fd.write("new")
+        self.assertEqual(self.fs.listdir(os.sep + "a" + os.sep + "dir"),
+            ["new.txt"])
+        entry = [itm for itm in self.fs.scandir(os.sep)\
+            if itm.name == "link"][0]
+        self.assertTrue(entry.is_dir())
+        self.assertFalse(entry.is_dir(follow_symlinks = False))
+
+    #Adding to a directory linked into a view doesn't add to the original
+    def test_view_links_are_separate(self):
+        course = os.sep + "course"
+        view = os.sep + "view"
+        dname = self.fs.listdir(course)[0]
+        self.fs.makedirs(course + os.sep + dname + os.sep + "src")
+        before = read_memory_tree(self.fs, course)
+        self.fs.makedirs(view)
+        flattener = renamefolders.Flattener(view, source = course,
+            symlink = True)
+        renamefolders.run_pipeline(course, flattener = flattener,
+            view = view, symlink = True, flatten = True)
+        src = [name for name in self.fs.listdir(view)\
+            if name.endswith("src")]
+        self.assertEqual(len(src), 1)
+        with self.fs.open(view + os.sep + src[0] + os.sep + "new.txt",
+                'w') as fd:
+            fd.write("new")
+        self.assertEqual(read_memory_tree(self.fs, course), before)
+
+if __name__ == '__main__':
+    unittest.main()